@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017-2025
+#               Free Software Foundation, Inc.
+# This file is part of Chisel.
+#
+# Chisel is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# Chisel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Chisel; see the file COPYING.  If not, write to the
+# Free Software Foundation, 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+#
+# Author Gaius Mulley <gaiusmod2@gmail.com>
+
+from array import array
+
+
+#
+#  grid - a two dimensional map of small integers (room numbers,
+#         wall, door and empty markers).  The cells are held in a
+#         single flat typed array so that reads and writes are O(1)
+#         and in place.  Coordinates are (x, y) and, like the list
+#         of lists it replaces, a negative coordinate counts back
+#         from the far edge and an out of range coordinate raises
+#         IndexError.
+#
+
+class grid:
+    def __init__ (self, maxx, maxy, value):
+        self.width = maxx + 1
+        self.height = maxy + 1
+        self.cells = array ('h', [value]) * (self.width * self.height)
+
+    #
+    #  _index - return the offset into cells for position x, y.
+    #
+
+    def _index (self, x, y):
+        if x < 0:
+            x += self.width
+        if y < 0:
+            y += self.height
+        if (x < 0) or (x >= self.width) or (y < 0) or (y >= self.height):
+            raise IndexError ("grid index out of range")
+        return y * self.width + x
+
+    #
+    #  get - return the value at x, y.
+    #
+
+    def get (self, x, y):
+        return self.cells[self._index (x, y)]
+
+    #
+    #  set - assign value to position x, y.
+    #
+
+    def set (self, x, y, value):
+        self.cells[self._index (x, y)] = value
+
+    #
+    #  hline - assign value to every cell from x0..x1 inclusive on row y.
+    #
+
+    def hline (self, x0, x1, y, value):
+        if x0 >= 0:
+            i = self._index (x0, y)
+            j = self._index (x1, y) + 1
+            self.cells[i:j] = array ('h', [value]) * (j - i)
+        else:
+            for x in range (x0, x1+1):
+                self.set (x, y, value)
+
+    #
+    #  vline - assign value to every cell from y0..y1 inclusive on column x.
+    #
+
+    def vline (self, x, y0, y1, value):
+        for y in range (y0, y1+1):
+            self.cells[self._index (x, y)] = value
+
+    #
+    #  flood - replace the 4-connected region of cells holding, empty,
+    #          which contains x, y with value.  It uses an iterative
+    #          scanline fill so large rooms do not exhaust the python
+    #          stack.  It returns the number of cells filled and the
+    #          bounding box [[minx, miny], [maxx, maxy]] of the region
+    #          (None if nothing was filled).
+    #
+
+    def flood (self, x, y, empty, value):
+        if (x < 0) or (y < 0) or (self.get (x, y) != empty):
+            return 0, None
+        cells = self.cells
+        width = self.width
+        count = 0
+        minx, miny, maxx, maxy = x, y, x, y
+        stack = [(x, y)]
+        while stack != []:
+            x, y = stack.pop ()
+            base = y * width
+            if cells[base + x] != empty:
+                continue
+            left = x
+            while (left > 0) and (cells[base + left - 1] == empty):
+                left -= 1
+            right = x
+            while (right < width - 1) and (cells[base + right + 1] == empty):
+                right += 1
+            cells[base + left:base + right + 1] = array ('h', [value]) * (right - left + 1)
+            count += right - left + 1
+            minx = min (minx, left)
+            maxx = max (maxx, right)
+            miny = min (miny, y)
+            maxy = max (maxy, y)
+            for ny in (y - 1, y + 1):
+                if (ny >= 0) and (ny < self.height):
+                    nbase = ny * width
+                    inSpan = False
+                    for nx in range (left, right + 1):
+                        if cells[nbase + nx] == empty:
+                            if not inSpan:
+                                stack += [(nx, ny)]
+                                inSpan = True
+                        else:
+                            inSpan = False
+        return count, [[minx, miny], [maxx, maxy]]
+
+    #
+    #  _wrapped - return the value at x, y or None if x, y lies beyond
+    #             the far edge of the grid.
+    #
+
+    def _wrapped (self, x, y):
+        try:
+            return self.get (x, y)
+        except IndexError:
+            return None
+
+    #
+    #  label - label every 4-connected region of cells holding, empty,
+    #          in a single two pass union-find sweep of the grid.
+    #          seeds is a list of [[x, y], value] pairs and each region
+    #          containing a seed is assigned the value of the first
+    #          seed found within it.  Regions without a seed are left
+    #          untouched.  probes is a list of [x, y] positions whose
+    #          four neighbours are recorded once the regions are labelled.
+    #          It returns a dictionary mapping each probe (x, y) to the
+    #          list of neighbour values [x-1, x+1, y-1, y+1].
+    #
+
+    def label (self, empty, seeds, probes):
+        cells = self.cells
+        width = self.width
+        labels = array ('i', [0]) * len (cells)
+        parent = [0]
+
+        def find (l):
+            while parent[l] != l:
+                parent[l] = parent[parent[l]]
+                l = parent[l]
+            return l
+
+        # first pass, provisional labels and equivalences.
+        i = 0
+        for y in range (self.height):
+            for x in range (width):
+                if cells[i] == empty:
+                    west = 0
+                    north = 0
+                    if x > 0:
+                        west = labels[i - 1]
+                    if y > 0:
+                        north = labels[i - width]
+                    if west and north:
+                        labels[i] = west
+                        a, b = find (west), find (north)
+                        if a != b:
+                            parent[max (a, b)] = min (a, b)
+                    elif west or north:
+                        labels[i] = west or north
+                    else:
+                        labels[i] = len (parent)
+                        parent += [len (parent)]
+                i += 1
+        # bind each region to the first seed within it.
+        value = {}
+        for pos, v in seeds:
+            if (pos[0] >= 0) and (pos[1] >= 0):
+                l = labels[self._index (pos[0], pos[1])]
+                if l != 0:
+                    value.setdefault (find (l), v)
+        # second pass, resolve the labels.
+        for i, l in enumerate (labels):
+            if l != 0:
+                root = find (l)
+                if root in value:
+                    cells[i] = value[root]
+        adjacent = {}
+        for x, y in probes:
+            adjacent[(x, y)] = [self._wrapped (x-1, y), self._wrapped (x+1, y),
+                                self._wrapped (x, y-1), self._wrapped (x, y+1)]
+        return adjacent
+
+    #
+    #  positions - return the list of [x, y] positions within x0..x1,
+    #              y0..y1 inclusive which hold, value.  The positions
+    #              are ordered by x and then y.
+    #
+
+    def positions (self, value, x0, x1, y0, y1):
+        cells = self.cells
+        width = self.width
+        result = []
+        for x in range (x0, x1+1):
+            for y in range (y0, y1+1):
+                if cells[y * width + x] == value:
+                    result += [[x, y]]
+        return result
+
+    #
+    #  row - return row, y, as a list.
+    #
+
+    def row (self, y):
+        i = self._index (0, y)
+        return self.cells[i:i+self.width].tolist ()
+
+    #
+    #  rows - return a list of all rows, the first row is y = 0.
+    #
+
+    def rows (self):
+        return [self.row (y) for y in range (self.height)]
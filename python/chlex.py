@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017-2025
+#               Free Software Foundation, Inc.
+# This file is part of Chisel.
+#
+# Chisel is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# Chisel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Chisel; see the file COPYING.  If not, write to the
+# Free Software Foundation, 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+#
+# Author Gaius Mulley <gaiusmod2@gmail.com>
+
+
+#
+#  penLexer - a streaming tokeniser for the pen file format.
+#             Tokens are whitespace separated words read lazily from
+#             the input file one line at a time.  Each token carries
+#             the line number it was found on and a single token of
+#             lookahead is kept so peek and get are O(1).  Once the
+#             input is exhausted the token <eof> is returned forever.
+#
+
+class penLexer:
+    def __init__ (self, inputFile):
+        self.lineNo = 1
+        self._tokens = self._scan (inputFile)
+        self._next = next (self._tokens)
+
+    #
+    #  _scan - yield each (token, lineNo) pair in, inputFile,
+    #          followed by <eof>.
+    #
+
+    def _scan (self, inputFile):
+        lineNo = 1
+        for lineNo, line in enumerate (inputFile, start=1):
+            for w in line.split ():
+                yield w, lineNo
+        while True:
+            yield '<eof>', lineNo
+
+    #
+    #  peek - return the next token without consuming it.
+    #
+
+    def peek (self):
+        self.lineNo = self._next[1]
+        return self._next[0]
+
+    #
+    #  get - consume and return the next token.
+    #
+
+    def get (self):
+        t, self.lineNo = self._next
+        self._next = next (self._tokens)
+        return t
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017-2025
+#               Free Software Foundation, Inc.
+# This file is part of Chisel.
+#
+# Chisel is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# Chisel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Chisel; see the file COPYING.  If not, write to the
+# Free Software Foundation, 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+#
+# Author Gaius Mulley <gaiusmod2@gmail.com>
+
+import sys
+import gzip
+import lzma
+
+chunkSize = 1 << 20    # characters collected before the file is written.
+
+
+#
+#  mapWriter - collects the many small strings written to a map file
+#              in a list and passes them to the file as one joined
+#              chunk once chunkSize characters have been collected.
+#
+
+class mapWriter:
+    def __init__ (self, outputFile):
+        self._file = outputFile
+        self._pending = []
+        self._size = 0
+
+    #
+    #  write - append text to the output.
+    #
+
+    def write (self, text):
+        self._pending += [text]
+        self._size += len (text)
+        if self._size >= chunkSize:
+            self._drain ()
+
+    #
+    #  _drain - pass the collected text to the file.
+    #
+
+    def _drain (self):
+        if self._pending != []:
+            self._file.write (''.join (self._pending))
+            self._pending = []
+            self._size = 0
+
+    #
+    #  flush - write all collected text and flush the file.
+    #
+
+    def flush (self):
+        self._drain ()
+        self._file.flush ()
+
+    #
+    #  close - flush and close the file.  stdout is flushed but
+    #          left open.
+    #
+
+    def close (self):
+        self.flush ()
+        if self._file != sys.stdout:
+            self._file.close ()
+
+
+#
+#  openMap - return a mapWriter for the file, name.  A name ending in
+#            .gz or .xz is compressed with gzip or lzma and - is stdout.
+#
+
+def openMap (name):
+    if name == '-':
+        return mapWriter (sys.stdout)
+    if name.endswith ('.gz'):
+        return mapWriter (gzip.open (name, 'wt'))
+    if name.endswith ('.xz'):
+        return mapWriter (lzma.open (name, 'wt'))
+    return mapWriter (open (name, 'w'))
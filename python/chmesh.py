@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017-2025
+#               Free Software Foundation, Inc.
+# This file is part of Chisel.
+#
+# Chisel is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# Chisel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Chisel; see the file COPYING.  If not, write to the
+# Free Software Foundation, 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+#
+# Author Gaius Mulley <gaiusmod2@gmail.com>
+
+
+#
+#  _boundaries - return the sorted list of distinct coordinates used
+#                by boxes in dimension, dim, and a dictionary mapping
+#                each coordinate to its index.
+#
+
+def _boundaries (boxes, dim):
+    coords = set ()
+    for pos, end in boxes:
+        coords.add (pos[dim])
+        coords.add (end[dim])
+    coords = sorted (coords)
+    index = {}
+    for i, c in enumerate (coords):
+        index[c] = i
+    return coords, index
+
+
+#
+#  _voxels - return the set of (i, j, k) cells of the compressed grid
+#            covered by boxes.
+#
+
+def _voxels (boxes, xindex, yindex, zindex):
+    filled = set ()
+    for pos, end in boxes:
+        for i in range (xindex[pos[0]], xindex[end[0]]):
+            for j in range (yindex[pos[1]], yindex[end[1]]):
+                for k in range (zindex[pos[2]], zindex[end[2]]):
+                    filled.add ((i, j, k))
+    return filled
+
+
+#
+#  greedyMesh - return a list of [pos, end] boxes which exactly cover
+#               the union of, boxes, a list of [pos, end] axis aligned
+#               boxes.  The space is split along every box face into
+#               a compressed grid and then, visiting the cells in z, y,
+#               x order, each unused cell is grown as far as possible
+#               along x, then y and then z.  The result does not
+#               depend upon the order of boxes and the boxes returned
+#               do not overlap.
+#
+
+def greedyMesh (boxes):
+    xs, xindex = _boundaries (boxes, 0)
+    ys, yindex = _boundaries (boxes, 1)
+    zs, zindex = _boundaries (boxes, 2)
+    filled = _voxels (boxes, xindex, yindex, zindex)
+    result = []
+    for k0, j0, i0 in sorted ((k, j, i) for i, j, k in filled):
+        if not ((i0, j0, k0) in filled):
+            continue
+        i1 = i0
+        while (i1 + 1, j0, k0) in filled:
+            i1 += 1
+        j1 = j0
+        while all ((i, j1 + 1, k0) in filled for i in range (i0, i1+1)):
+            j1 += 1
+        k1 = k0
+        while all ((i, j, k1 + 1) in filled
+                   for i in range (i0, i1+1) for j in range (j0, j1+1)):
+            k1 += 1
+        for i in range (i0, i1+1):
+            for j in range (j0, j1+1):
+                for k in range (k0, k1+1):
+                    filled.remove ((i, j, k))
+        result += [[[xs[i0], ys[j0], zs[k0]], [xs[i1+1], ys[j1+1], zs[k1+1]]]]
+    return result
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017-2025
+#               Free Software Foundation, Inc.
+# This file is part of Chisel.
+#
+# Chisel is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# Chisel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Chisel; see the file COPYING.  If not, write to the
+# Free Software Foundation, 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+#
+# Author Gaius Mulley <gaiusmod2@gmail.com>
+
+#
+#  numpy is optional, if it is not installed the callers must use
+#  their own pure python plane code.
+#
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+#
+#  available - return True if the vectorised plane code can be used.
+#
+
+def available ():
+    return numpy != None
+
+
+#
+#  solveFaces - return the unit normals, distances and off plane points
+#               of every face in a single batch.  points is a list of
+#               [x, y, z] vertices which are multiplied by, scale.
+#               corners[i] holds the indices into points of the first
+#               three vertices p0, p1, p2 of face i whose normal is the
+#               normalised (p2 - p0) x (p1 - p0) and whose plane is
+#               n.p + d = 0.  owners[j] is the face which points[j]
+#               belongs to.  It returns a list of [a, b, c] normals, a
+#               list of distances and the list of indices into points
+#               which do not lie within, limit, of the plane of their
+#               face.
+#
+
+def solveFaces (points, corners, owners, scale, limit):
+    if len (corners) == 0:
+        return [], [], []
+    p = numpy.array (points, dtype=float) * scale
+    c = numpy.array (corners, dtype=int)
+    p0 = p[c[:, 0]]
+    n = numpy.cross (p[c[:, 2]] - p0, p[c[:, 1]] - p0)
+    n = n / numpy.linalg.norm (n, axis=1)[:, None]
+    d = - numpy.einsum ('ij,ij->i', p0, n)
+    o = numpy.array (owners, dtype=int)
+    r = numpy.einsum ('ij,ij->i', p, n[o]) + d[o]
+    bad = numpy.nonzero (numpy.abs (r) >= limit)[0]
+    return n.tolist (), d.tolist (), bad.tolist ()
@@ -25,8 +25,14 @@
 import argparse, sys, string
 from chvec import *
 from chcuboid import *
-import math, random
-from poly import poly, vec, unit_tests, mat
+from chgrid import grid
+from chlex import penLexer
+from chmesh import greedyMesh
+from chmapfile import openMap
+import chplanes
+import io, math, random, functools
+import concurrent.futures, multiprocessing
+from poly import poly, vec, unit_tests, mat, set_exact
 
 
 """
@@ -90,14 +96,15 @@ defines = {}
 debugFloorLevel = False
 toTxt, toMap = False, False
 ssName = None
-floor = []
+floor = None
+roomCells = {}
+doorCells = {}
 rooms = {}
 brushes = {}
 maxx, maxy = 0, 0
 doorValue, wallValue, emptyValue = 0, -1, -2
 versionNumber = "0.1"
-currentLineNo = 1
-words = []
+tokens = None
 curStatus = None
 status_open, status_closed, status_secret = list (range (3))
 curRoom = None
@@ -109,6 +116,7 @@ maxEntities = 4096    # doom3 limitation
 singlePlayer, deathMatch = list(range(2))
 maxd3Units = 5000
 minx, miny, minz, maxz = None, None, None, None
+minInches = None      #  minvec in whole inches (or None).
 lightPoints = []
 optimise = False
 regressionRequired = False
@@ -237,45 +245,17 @@ def coke_can (r, x, y, z):
     rooms[r].cokeCans += [coke (x, y, z)]
 
 
-def cut (l, i):
-    if i == 0:
-        if len (l) > 1:
-            return None, l[i], l[i+1:]
-        return None, l[i], None
-    if len (l) > i+1:
-        return l[:i], l[i], l[i+1:]
-    return l[:i], l[i], None
-
-
-def stitch (a, b, c):
-    if a == None:
-        d = b
-    else:
-        d = a + b
-    if c == None:
-        return d
-    return d + c
-
-
 def setFloor (x, y, value):
-    global floor
-    a, b, c = cut (floor, y)
-    x, y, z = cut (b, x)
-    b = stitch (x, [value], z)
-    floor = stitch (a, [b], c)
+    floor.set (x, y, value)
 
 
 def getFloor (x, y):
-    global floor
-    return floor[y][x]
+    return floor.get (x, y)
 
 
 def initFloor (x, y, value):
     global floor
-    floor = []
-    for j in range (y+1):
-        row = [value] * (x+1)
-        floor += [row]
+    floor = grid (x, y, value)
 
 
 #
@@ -321,8 +301,105 @@ def vecInches2 (vec):
     return result
 
 
+#
+#  spatialHash - an index of the cuboids bucketed by kind (the
+#                material and transform pair) and by the unit pen
+#                column (x, y) cells each cuboid touches.  It answers
+#                which cuboids of a kind touch or contain a box without
+#                scanning every cuboid.  A cuboid must be updated in
+#                the index whenever it grows.  The cells of a cuboid
+#                are found from its whole inch corners when it has them.
+#
+
+class spatialHash:
+    def __init__ (self):
+        self.kinds = {}
+        self.buckets = {}
+        self.keys = {}
+        self.firstKind = None
+        self.firstOther = None
+
+    #
+    #  kind - return the interned kind number for material, transform.
+    #
+
+    def kind (self, material, transform):
+        k = (material, transform)
+        if not (k in self.kinds):
+            self.kinds[k] = len (self.kinds)
+        return self.kinds[k]
+
+    #
+    #  _cells - return the bucket keys covering pos..end for kind.
+    #           inches is None or the [pos, end] corners in whole inches.
+    #
+
+    def _cells (self, kind, pos, end, inches):
+        if inches == None:
+            x0, x1 = int (math.floor (pos[0])), int (math.floor (end[0]))
+            y0, y1 = int (math.floor (pos[1])), int (math.floor (end[1]))
+        else:
+            x0, x1 = inches[0][0] // inchesPerUnit, inches[1][0] // inchesPerUnit
+            y0, y1 = inches[0][1] // inchesPerUnit, inches[1][1] // inchesPerUnit
+        return [(kind, x, y) for x in range (x0, x1+1) for y in range (y0, y1+1)]
+
+    #
+    #  add - add cuboid, b, to the index.
+    #
+
+    def add (self, b):
+        kind = self.kind (b.material, b.transform)
+        if self.firstKind == None:
+            self.firstKind = kind
+        elif (self.firstOther == None) and (kind != self.firstKind):
+            self.firstOther = b.cuboidno
+        self.keys[b.cuboidno] = self._cells (kind, b.pos, b.end, b.inches)
+        for key in self.keys[b.cuboidno]:
+            self.buckets.setdefault (key, []).append (b.cuboidno)
+
+    #
+    #  update - rebucket cuboid, b, after it has been enlarged.
+    #
+
+    def update (self, b):
+        for key in self.keys[b.cuboidno]:
+            self.buckets[key].remove (b.cuboidno)
+        kind = self.kind (b.material, b.transform)
+        self.keys[b.cuboidno] = self._cells (kind, b.pos, b.end, b.inches)
+        for key in self.keys[b.cuboidno]:
+            self.buckets.setdefault (key, []).append (b.cuboidno)
+
+    #
+    #  near - return the sorted list of cuboid numbers of, kind, which
+    #         share a cell with pos..end.  Every cuboid which touches
+    #         or contains pos..end is included.  inches is None or the
+    #         [pos, end] corners in whole inches.
+    #
+
+    def near (self, kind, pos, end, inches):
+        found = set ()
+        for key in self._cells (kind, pos, end, inches):
+            if key in self.buckets:
+                found.update (self.buckets[key])
+        return sorted (found)
+
+    #
+    #  firstDiffering - return the number of the first cuboid added
+    #                   whose kind differs from, kind, or None.
+    #
+
+    def firstDiffering (self, kind):
+        if self.firstKind == None:
+            return None
+        if kind != self.firstKind:
+            return 1
+        return self.firstOther
+
+
 cuboidno = 1          #  total number of extendable cuboids used.
 cuboids = {}
+cuboidHash = spatialHash ()
+meshedCuboids = 0     #  number of cuboids removed by meshCuboids.
 roofno = 1
 roofBricks = {}
 polyobjno = 1         #  number of non extenable bricks used
@@ -403,57 +480,82 @@ def addpolyobj (polygon_points, faces, material, room, name):
 
 #
 #  addcuboid - adds a cuboid brick to the dictionary of bricks.
-#              Each cuboid has a unique number.
+#              Each cuboid has a unique number.  inches is None or
+#              the [pos, end] corners in whole inches which are kept
+#              with the cuboid as its inches attribute.
 #
 
-def addcuboid (pos, size, material, transform, fixed):
+def addcuboid (pos, size, material, transform, fixed, inches):
     global cuboids, cuboidno
 
     cuboids[cuboidno] = cuboid (pos, size, material, transform, cuboidno, fixed)
+    cuboids[cuboidno].inches = inches
+    cuboidHash.add (cuboids[cuboidno])
     cuboidno += 1
 
 
 #
 #  combined - returns True if the cuboid represented by pos, size
-#             can be combined with an existing cuboid.
+#             can be combined with an existing cuboid.  Only the
+#             cuboids added before the first cuboid of a differing
+#             material or transform are candidates for merging.
 #
 
-def combined (pos, size, material, transform, fixed):
+def combined (pos, size, material, transform, fixed, inches):
     if args.debug:
         print ("examine cuboid", pos, size, end=' ')
-    for k in list(cuboids.keys ()):
+    kind = cuboidHash.kind (material, transform)
+    limit = cuboidHash.firstDiffering (kind)
+    for k in cuboidHash.near (kind, pos, addVec (pos, size), inches):
+        if (limit != None) and (k > limit):
+            break
         b = cuboids[k]
-        if (b.material != material) or (b.transform != transform):
-            if b.interpenetration (pos, size):
-                print ("brick at", pos, size, "intersects with", b.pos, b.size, b.cuboidno)
-                error ("brick is being overwritten   (consider giving the room number for more detail)  the two cubiods have material " + b.material + " and " + material)
-            # differing material cannot be merged.
-            if args.debug:
-                print ("differing material")
-            return False
         if b.combined (pos, size, material, transform, fixed):
+            b.inches = enlargeInches (b, inches)
+            cuboidHash.update (b)
             if args.debug:
                 print ("combined!")
             return True
+    if limit != None:
+        b = cuboids[limit]
+        if b.interpenetration (pos, size):
+            print ("brick at", pos, size, "intersects with", b.pos, b.size, b.cuboidno)
+            error ("brick is being overwritten   (consider giving the room number for more detail)  the two cubiods have material " + b.material + " and " + material)
+        # differing material cannot be merged.
+        if args.debug:
+            print ("differing material")
+        return False
     if args.debug:
         print ("no join")
     return False
 
 
+#
+#  enlargeInches - return the whole inch corners of cuboid, b, after it
+#                  has been enlarged to contain the cuboid whose whole
+#                  inch corners are, inches.  None is returned if either
+#                  cuboid is not on the inch lattice.
+#
+
+def enlargeInches (b, inches):
+    if (b.inches == None) or (inches == None):
+        return fixedBox (b.pos, b.end)
+    return [minVec (b.inches[0], inches[0]), maxVec (b.inches[1], inches[1])]
+
+
 #
 #  alreadyExists - returns True if the cuboid already exists.
 #
 
-def alreadyExists (pos, size, material, transform):
+def alreadyExists (pos, size, material, transform, inches):
     if args.debug:
         print ("checking", material)
-    for k in list (cuboids.keys ()):
-        b = cuboids[k]
-        if (b.material == material) and (b.transform == transform):
-            if b.subset (pos, size):
-                if args.debug:
-                    print ("yes found duplicate", material)
-                return True
+    kind = cuboidHash.kind (material, transform)
+    for k in cuboidHash.near (kind, pos, addVec (pos, size), inches):
+        if cuboids[k].subset (pos, size):
+            if args.debug:
+                print ("yes found duplicate", material)
+            return True
     return False
 
 
@@ -480,9 +582,11 @@ def chooseBrick ():
 #  newcuboid - this is the default mechanism to build a cuboid.
 #              It checks whether it is possible to expand an
 #              existing cuboid before creating another cuboid.
+#              The corners are converted into whole inches once here.
 #
 
 def newcuboid (pos, size, material, roomNo, allowExtend = True, fixed = True):
+    inches = fixedBox (pos, addVec (pos, size))
     transform = lookupTransform (roomNo, material)
     if material == "secret":
         doommat = chooseBrick ()
@@ -491,16 +595,16 @@ def newcuboid (pos, size, material, roomNo, allowExtend = True, fixed = True):
     #
     #  does the cuboid already exist?  If so ignore this new cuboid request.
     #
-    if not alreadyExists (pos, size, doommat, transform):
+    if not alreadyExists (pos, size, doommat, transform, inches):
         #  are we allowed to try and extend a previous cuboid to encompass this new cuboid?
         if allowExtend:
             #  can we extend a previous cuboid to encompass this new cuboid?
-            if not combined (pos, size, doommat, transform, fixed):
+            if not combined (pos, size, doommat, transform, fixed, inches):
                 # ok we must add a newcuboid
-                addcuboid (pos, size, doommat, transform, fixed)
+                addcuboid (pos, size, doommat, transform, fixed, inches)
         else:
             # ok we are forced into adding a newcuboid
-            addcuboid (pos, size, doommat, transform, fixed)
+            addcuboid (pos, size, doommat, transform, fixed, inches)
 
 transformCount = None
 
@@ -631,6 +735,7 @@ class roomInfo:
         self.lights = []
         self.worldspawn = []
         self.floorLevel = None
+        self.floorBox = None
         self.inside = None
         self.defaultColours = {}
         self.defaultTextures = {}
@@ -723,7 +828,7 @@ class light:
         # v = midReposition (p)
         # print "minz =", minz, "maxz =", maxz, "minx =", minx, "miny =", miny, "p =", p
         # print v
-        o.write ('%f %f %f"\n' % (v[0], v[1], v[2]))
+        o.write (originText (v) + '"\n')
         return o
 
 
@@ -830,7 +935,7 @@ def initOptions ():
                          help='specify the sheet filename',
                          default=None, action='store')
     parser.add_argument ('-o', '--outputfile',
-                         help='specify the output filename',
+                         help='specify the output filename, a .gz or .xz suffix compresses the map',
                          default=None, action='store')
     parser.add_argument ('-i', '--inputfile',
                          help='specify the input filename',
@@ -872,8 +977,20 @@ def initOptions ():
                          help='enable lights on the floor',
                          default=False, action='store_true')
     parser.add_argument ('-O', '--optimize',
-                         help='optimize cuboid generation',
+                         help='optimize cuboid generation, -OO also re-meshes the fixed cuboids to reduce the brush count',
+                         default=0, action='count')
+    parser.add_argument ('-N', '--vectorise',
+                         help='compute the roof and polygon brick planes which are not on the inch lattice in a single batch using numpy (if installed)',
+                         default=False, action='store_true')
+    parser.add_argument ('-X', '--exact',
+                         help='build the polygon objects (stairs and pillars) with Decimal rather than float coordinates',
                          default=False, action='store_true')
+    parser.add_argument ('-j', '--jobs',
+                         help='format the brushes using this many worker processes',
+                         default=1, action='store', type=int)
+    parser.add_argument ('-r', '--precision',
+                         help='round the plane normals and distances to this many decimal places',
+                         default=None, action='store', type=int)
     parser.add_argument ('-v', '--version',
                          help='print the version',
                          default=False, action='store_true')
@@ -881,8 +998,7 @@ def initOptions ():
 
 
 def errorLine (text):
-    global currentLineNo
-    full = "%s:%d:%s\n" % (args.inputfile, currentLineNo, text)
+    full = "%s:%d:%s\n" % (args.inputfile, tokens.lineNo, text)
     print (full)
     sys.stderr (full)
 
@@ -922,14 +1038,14 @@ def findMax (r):
             maxy = max (c[1], maxy)
 
 
+#
+#  floodFloor - fill the empty floor region containing, p, with room number, r.
+#               It returns the bounding box [[minx, miny], [maxx, maxy]] of
+#               the region or None if nothing was filled.
+#
+
 def floodFloor (r, p):
-    if p[0] >= 0 and p[1] >= 0:
-        if getFloor (p[0], p[1]) == emptyValue:
-            setFloor (p[0], p[1], r)
-            floodFloor (r, [p[0]-1, p[1]])
-            floodFloor (r, [p[0]+1, p[1]])
-            floodFloor (r, [p[0], p[1]-1])
-            floodFloor (r, [p[0], p[1]+1])
+    return floor.flood (p[0], p[1], emptyValue, r)[1]
 
 
 def floodRoom (r, p):
@@ -939,65 +1055,72 @@ def floodRoom (r, p):
             print("will start")
         else:
             print("will not start", getFloor (p[0], p[1]))
-    floodFloor (int (r), p)
+    return floodFloor (int (r), p)
 
 
-def findDoors (r, p):
-    for d in rooms[r].doors:
-        if d[0][0] == d[1][0]:
-            # vertical door
-            if getFloor (d[0][0]+1, d[0][1]) != int (r):
-                rooms[r].doorLeadsTo += [getFloor (d[0][0]+1, d[0][1])]
-            else:
-                rooms[r].doorLeadsTo += [getFloor (d[0][0]-1, d[0][1])]
-        else:
-            # horizontal
-            if getFloor (d[0][0], d[0][1]+1) != int (r):
-                rooms[r].doorLeadsTo += [getFloor (d[0][0], d[0][1]+1)]
+#
+#  indexDoors - return a dictionary mapping each (x, y) cell covered by
+#               a door to the list of [room, door, sides] records of the
+#               doors covering it.  sides holds the floor values either
+#               side of the cell, see doorSides.
+#
+
+def indexDoors ():
+    cells = {}
+    for r in list (rooms.keys ()):
+        for d in rooms[r].doors:
+            coords = d[0]
+            if coords[0][0] == coords[1][0]:
+                # vertical
+                for y in range (min (coords[0][1], coords[1][1]), max (coords[0][1], coords[1][1])+1):
+                    cells.setdefault ((coords[0][0], y), [])
+                    cells[(coords[0][0], y)] += [[r, d, doorSides (coords[0][0], y)]]
             else:
-                rooms[r].doorLeadsTo += [getFloor (d[0][0], d[0][1]-1)]
+                # horizontal
+                for x in range (min (coords[0][0], coords[1][0]), max (coords[0][0], coords[1][0])+1):
+                    cells.setdefault ((x, coords[0][1]), [])
+                    cells[(x, coords[0][1])] += [[r, d, doorSides (x, coords[0][1])]]
+    return cells
 
 
-def doGetToken ():
-    global words
-    if len (words) > 1:
-        return words[0], words[1:]
-    elif len (words) == 1:
-        return words[0], ['<eof>']
+#
+#  doorSides - return the floor values either side of the door cell
+#              x, y as [[left, right], [below, above]].
+#
 
+def doorSides (x, y):
+    return [[getFloor (x-1, y), getFloor (x+1, y)],
+            [getFloor (x, y-1), getFloor (x, y+1)]]
 
-def expectEoln ():
-    global currentLineNo, words
-    if words[0] == '<eoln>':
-        currentLineNo += 1
-        words = words[1:]
+
+#
+#  joinedRooms - return the floor values [lower, upper] either side of
+#                the first cell of the door entity, e, from doorCells.
+#                A left or right door joins the cells to its left and
+#                right, a top or bottom door joins those below and above.
+#
+
+def joinedRooms (e):
+    sides = doorCells[(e[0][0], e[0][1])][0][2]
+    if (e[-1] == 'left') or (e[-1] == 'right'):
+        return sides[0]
+    return sides[1]
 
 
 #
-#  get - returns the next token and the remainder of the words.
+#  get - returns the next token.
 #
 
 def get ():
-    global currentLineNo, words
-    n, words = doGetToken ()
-    while n == '<eoln>':
-        expectEoln ()
-        n, words = doGetToken ()
-    return n
+    return tokens.get ()
 
 
 #
 #  peek - returns the first token without removing it from input.
-#         It will advance the linenumber if <eoln> is seen.
 #
 
 def peek ():
-    global currentLineNo, words
-    n = words[0]
-    while n == '<eoln>':
-        expectEoln ()
-        return peek ()
-    return n
+    return tokens.peek ()
 
 
 #
@@ -1035,25 +1158,6 @@ def expecting (l):
     return t in l
 
 
-#
-#  lexicalPen - return a list of tokens to be read by the parser.
-#               A special token <eoln> is added at the end of each line.
-#               <eof> is added at the end.
-#
-
-def lexicalPen (i):
-    words = []
-    for l in i.readlines ():
-        w = l.split ()
-        w += ['<eoln>']
-        for j in w:
-            if j != "":
-                i = j.rstrip ()
-                words += [i]
-    words += ['<eof>']
-    return words
-
-
 #
 #  wallCoords := Integer Integer Integer Integer =:
 #
@@ -1689,18 +1793,16 @@ def toIntList (l):
 
 
 #
-#  plotLine - draws a line described by, l, using character, value.
+#  plotLine - draws a line described by, l, using value.
 #
 
 def plotLine (l, value):
     x0, y0 = getPos (l[0])
     x1, y1 = getPos (l[1])
     if x0 == x1:
-        for j in range (min (y0, y1), max (y0, y1)+1):
-            setFloor (x0, j, value)
+        floor.vline (x0, min (y0, y1), max (y0, y1), value)
     else:
-        for i in range (min (x0, x1), max (x0, x1)+1):
-            setFloor (i, y0, value)
+        floor.hline (min (x0, x1), max (x0, x1), y0, value)
 
 
 #
@@ -1709,17 +1811,17 @@ def plotLine (l, value):
 
 def generateTxtRoom (r):
     for w in rooms[r].walls:
-        plotLine (w, '#')
+        plotLine (w, ord ('#'))
     for d in rooms[r].doors:
         if d[2] == status_open:
-            plotLine (d[0], '.')
+            plotLine (d[0], ord ('.'))
         elif d[2] == status_closed:
             if d[0][0][0] == d[0][1][0]:
-                plotLine (d[0], '|')
+                plotLine (d[0], ord ('|'))
             else:
-                plotLine (d[0], '-')
+                plotLine (d[0], ord ('-'))
         elif d[2] == status_secret:
-            plotLine (d[0], '=')
+            plotLine (d[0], ord ('='))
 
 
 #
@@ -1727,13 +1829,11 @@ def generateTxtRoom (r):
 #
 
 def generateTxt (o):
-    initFloor (maxx, maxy, ' ')
+    initFloor (maxx, maxy, ord (' '))
     for r in list(rooms.keys ()):
         generateTxtRoom (r)
-    floor.reverse ()
-    for r in floor:
-        for c in r[1:]:
-            o.write (c)
+    for y in range (maxy, -1, -1):
+        o.write (''.join (map (chr, floor.row (y)[1:])))
         o.write ('\n')
     return o
 
@@ -2280,8 +2380,7 @@ def toInches (f, i = 0):
 
 def writeComment (o, comment):
     if comment != "":
-        o.write ('             ')
-        o.write ('// ' + comment + '\n')
+        o.write ('             // ' + comment + '\n')
     return o
 
 
@@ -2291,9 +2390,8 @@ def writeComment (o, comment):
 
 def yPlane (o, d, x0, text, transform, comment):
     o = writeComment (o, comment)
-    o.write ('             ')
-    o.write ('( 0 ' + str (d) + ' 0 ' + str (x0) + ' ) ')
-    o.write (transform + ' "' + text + '" 0 0 0\n')
+    o.write (''.join (['             ( 0 ', str (d), ' 0 ', str (x0), ' ) ',
+                       transform, ' "', text, '" 0 0 0\n']))
     return o
 
 #
@@ -2302,9 +2400,8 @@ def yPlane (o, d, x0, text, transform, comment):
 
 def xPlane (o, d, y0, text, transform, comment):
     o = writeComment (o, comment)
-    o.write ('             ')
-    o.write ('( ' + str (d) + ' 0 0 ' + str (y0) + ' ) ')
-    o.write (transform + ' "' + text + '" 0 0 0\n')
+    o.write (''.join (['             ( ', str (d), ' 0 0 ', str (y0), ' ) ',
+                       transform, ' "', text, '" 0 0 0\n']))
     return o
 
 
@@ -2315,9 +2412,8 @@ def xPlane (o, d, y0, text, transform, comment):
 def zPlane (o, d, z0, text, transform, comment):
     assert (z0 != 0)
     o = writeComment (o, comment)
-    o.write ('             ')
-    o.write ('( 0 0 ' + str (d) + ' ' + str (-z0) + ' ) ')
-    o.write (transform + ' "' + text + '" 0 0 0\n')
+    o.write (''.join (['             ( 0 0 ', str (d), ' ', str (-z0), ' ) ',
+                       transform, ' "', text, '" 0 0 0\n']))
     return o
 
 #
@@ -2352,16 +2448,72 @@ def simplify_vec (vec):
 #
 
 def plane (o, vec, distance, material, transform, comment):
-    vec = simplify_vec (vec)
-    distance = simplify_unit (distance)
     o = writeComment (o, comment)
-    o.write ('             ')
-    o.write ('( ' + str (vec[0]) + ' ' + str (vec[1])
-             + ' ' + str (vec[2]) + ' ' + str (distance) + ' ) ')
-    o.write (transform + ' "' + material + '" 0 0 0\n')
+    o.write (''.join (['             ', planeText (vec, distance),
+                       transform, ' "', material, '" 0 0 0\n']))
     return o
 
 
+#
+#  planeText - return the map file text of the plane, vec, distance.
+#
+
+def planeText (vec, distance):
+    return ('( ' + unitText (vec[0]) + ' ' + unitText (vec[1])
+            + ' ' + unitText (vec[2]) + ' ' + unitText (distance) + ' ) ')
+
+
+#
+#  unitText - return the map file text of the plane component, unit.
+#             The text of each value is remembered as most components
+#             are whole inches or unit normals.  The value is rounded
+#             to args.precision decimal places if it was given.
+#
+
+unitTextCache = {}       # (type, value, exponent) -> text
+
+def unitText (unit):
+    #  equal Decimals may differ in their trailing zeros, which str
+    #  shows, so the exponent of a Decimal is part of its key.
+    if isinstance (unit, Decimal):
+        key = (Decimal, unit, unit.as_tuple ().exponent)
+    else:
+        key = (unit.__class__, unit, None)
+    if key in unitTextCache:
+        return unitTextCache[key]
+    if args.precision != None:
+        unit = round (unit, args.precision)
+    text = str (simplify_unit (unit))
+    unitTextCache[key] = text
+    return text
+
+
+#
+#  originText - return the map file text of the position, v.
+#
+
+def originText (v):
+    return fixedText (v[0]) + ' ' + fixedText (v[1]) + ' ' + fixedText (v[2])
+
+
+#
+#  fixedText - return value formatted with six decimal places,
+#              the text of each value is remembered.
+#
+
+fixedTextCache = {}      # (type, value, sign) -> text
+
+def fixedText (value):
+    #  0.0 and -0.0 are equal but '%f' shows the sign, so the sign
+    #  is part of the key.
+    key = (value.__class__, value, math.copysign (1, value))
+    if key in fixedTextCache:
+        return fixedTextCache[key]
+    text = '%f' % value
+    fixedTextCache[key] = text
+    return text
+
+
 def mag (v):
     d = 0
     for i in v:
@@ -2395,15 +2547,228 @@ def reorderVertices (v0, v1):
 #          v0 and v1 must be opposite corners of the cuboid.
 #          v0 = [x, y, z]
 #          v1 = [x, y, z]
+#          The six planes are written directly from the integer
+#          inch corners by cuboidPlanes unless the generic path
+#          in roof is required.  inches is None or the corners in
+#          whole inches if they are already known.
+#
+
+def brick (o, v0, v1, material, transform, inches = None):
+    if inches == None:
+        inches = fixedBox (v0, v1)
+    planes = cuboidPlanes (inches)
+    if planes == None:
+        v0 = translatePos (v0)
+        v1 = translatePos (v1)
+        v0, v1 = reorderVertices (v0, v1)
+        points, faces = generate_cube_points (v0, v1)
+        o = roof (o, points, faces, material, transform)
+    else:
+        for normal, distance in planes:
+            o = plane (o, normal, distance, material, transform, "")
+    return o
+
+
+#
+#  fixedInches - return the pen unit, f, as a whole number of inches,
+#                or None if f is not a multiple of 1/inchesPerUnit.
+#
+
+def fixedInches (f):
+    d3 = f*inchesPerUnit
+    if d3 != int (d3):
+        return None
+    return int (d3)
+
+
+#
+#  fixedVec - return the pen vector, v, in whole inches, or None.
+#
+
+def fixedVec (v):
+    result = []
+    for f in v:
+        d3 = fixedInches (f)
+        if d3 == None:
+            return None
+        result += [d3]
+    return result
+
+
+#
+#  fixedBox - return the corners, v0 and v1, as [p0, p1] in whole inches,
+#             or None if either corner is not on the inch lattice.
+#
+
+def fixedBox (v0, v1):
+    p0 = fixedVec (v0)
+    p1 = fixedVec (v1)
+    if (p0 == None) or (p1 == None):
+        return None
+    return [p0, p1]
+
+
+#
+#  cuboidPlanes - return the six [vec, distance] planes of the cuboid
+#                 whose opposite corners in whole inches are, inches,
+#                 in the order front, right, left, back, top and bottom
+#                 used by generate_cube_points.  The planes are found
+#                 with integer arithmetic.  None is returned if inches
+#                 is None, the cuboid is flat or it lies outside the
+#                 map, in which case roof must be used.
 #
 
-def brick (o, v0, v1, material, transform):
-    v0 = translatePos (v0)
-    v1 = translatePos (v1)
-    v0, v1 = reorderVertices (v0, v1)
-    size = subVec (v1, v0)
-    points, faces = generate_cube_points (v0, v1)
-    o = roof (o, points, faces, material, transform)
+def cuboidPlanes (inches):
+    if (inches == None) or (minInches == None):
+        return None
+    lo, hi = reorderVertices (inches[0], inches[1])
+    if (lo[0] == hi[0]) or (lo[1] == hi[1]) or (lo[2] == hi[2]):
+        return None
+    #  the doom3 x, y coordinates are reflected about the origin
+    #  and offset by twice minvec (translatePos and translatePoints).
+    x0 = 2 * minInches[0] - lo[0]
+    x1 = 2 * minInches[0] - hi[0]
+    y0 = 2 * minInches[1] - lo[1]
+    y1 = 2 * minInches[1] - hi[1]
+    for d3 in [x0, x1, y0, y1, lo[2], hi[2]]:
+        if -d3 >= maxd3Units:
+            return None
+    return [[[-1, 0, 0], x1],
+            [[0, -1, 0], y1],
+            [[0, 1, 0], -y0],
+            [[1, 0, 0], -x0],
+            [[0, 0, -1], lo[2]],
+            [[0, 0, 1], -hi[2]]]
+
+
+#
+#  intInches - return the pen unit, f, in whole doom3 inches, or None if
+#              the result is not an integer or is out of range.
+#
+
+def intInches (f):
+    d3 = f*inchesPerUnit
+    if d3 >= maxd3Units:
+        return None
+    d3 = invertAxis (d3)
+    if d3 != int (d3):
+        return None
+    return int (d3)
+
+
+#
+#  axisPlane - return the exact plane [vec, distance] of face, f, of the
+#              translated polygon_points if every vertex of the face
+#              shares the same whole inch coordinate on one axis.
+#              Otherwise None is returned.
+#
+
+def axisPlane (polygon_points, f):
+    p0 = polygon_points[f[0]]
+    for k in range (3):
+        if all (polygon_points[i][k] == p0[k] for i in f):
+            c = intInches (p0[k])
+            if c == None:
+                return None
+            n = crossProduct (subVec (polygon_points[f[2]], p0),
+                              subVec (polygon_points[f[1]], p0))
+            if n[k] == 0:
+                return None
+            vec = [0, 0, 0]
+            if n[k] > 0:
+                vec[k] = 1
+            else:
+                vec[k] = -1
+            return vec, - vec[k] * c
+    return None
+
+
+#
+#  latticePlane - return the exact plane [vec, distance] of face, f, of
+#                 the translated polygon_points or None.  Faces which lie
+#                 on an axis are handled by axisPlane.  If every vertex of
+#                 the face lies on the whole inch lattice the integer plane
+#                 equation is found and reduced by its gcd.  It is only
+#                 returned (normalised) if the length of the reduced
+#                 normal is an integer and every vertex lies on the plane.
+#                 Otherwise None is returned and calc_face must be used.
+#
+
+def latticePlane (polygon_points, f):
+    result = axisPlane (polygon_points, f)
+    if result != None:
+        return result
+    points = []
+    for i in f:
+        q = [intInches (e) for e in polygon_points[i]]
+        if None in q:
+            return None
+        points += [q]
+    p = points[0]
+    a, b, c = crossProduct (subVec (points[2], p), subVec (points[1], p))
+    if (a, b, c) == (0, 0, 0):
+        return None
+    a, b, c, d = simplify (a, b, c, distance (p, a, b, c))
+    for q in points[3:]:
+        if a * q[0] + b * q[1] + c * q[2] + d != 0:
+            return None
+    m2 = a * a + b * b + c * c
+    m = math.isqrt (m2)
+    if m * m != m2:
+        return None
+    vec = [Decimal (a) / Decimal (m), Decimal (b) / Decimal (m), Decimal (c) / Decimal (m)]
+    return vec, distance (decimalVec (p), vec[0], vec[1], vec[2])
+
+
+#
+#  facePlane - return the plane [vec, distance] of face, f, of the
+#              translated polygon_points.  Lattice aligned faces are
+#              solved exactly by latticePlane and any other face
+#              (such as rotated stair and arch geometry) is solved
+#              and verified by calc_face.
+#
+
+def facePlane (polygon_points, f):
+    result = latticePlane (polygon_points, f)
+    if result == None:
+        vec, distance = calc_face (polygon_points[f[0]], polygon_points[f[1]], polygon_points[f[2]])
+        verify_plane_points (vec, distance, f, polygon_points)
+        return vec, distance
+    return result
+
+
+#
+#  cachedPlaneText - return the plane text of the face whose translated
+#                    vertices are the tuple of tuples, vertices.  The
+#                    most recently used planeCacheSize faces are
+#                    remembered so repeated faces are only solved once.
+#                    Cuboids on the inch lattice do not use the cache as
+#                    their planes are found directly by cuboidPlanes.
+#
+
+planeCacheSize = 4096
+
+@functools.lru_cache (maxsize=planeCacheSize)
+def cachedPlaneText (vertices):
+    vec, distance = facePlane (vertices, range (len (vertices)))
+    return planeText (vec, distance)
+
+
+#
+#  facePlaneText - return the plane text of face, f, of the translated
+#                  polygon_points.
+#
+
+def facePlaneText (polygon_points, f):
+    return cachedPlaneText (tuple (tuple (polygon_points[i]) for i in f))
+
+
+#
+#  writePlane - write the plane, text, with material and transform.
+#
+
+def writePlane (o, text, material, transform):
+    o.write (''.join (['             ', text, transform, ' "', material, '" 0 0 0\n']))
     return o
 
 
@@ -2453,10 +2818,10 @@ def gcd4 (a, b, c, d):
 
 def simplify (a, b, c, d):
     e = gcd4 (a, b, c, d)
-    a /= e
-    b /= e
-    c /= e
-    d /= e
+    a //= e
+    b //= e
+    c //= e
+    d //= e
     return a, b, c, d
 
 #
@@ -2562,61 +2927,194 @@ def verify_plane_points (vec, distance, f, polygon_points):
 #
 
 def roof (o, polygon_points, faces, material, transform):
+    polygon_points = roofPoints (polygon_points)
+    for i, f in enumerate (faces):
+        o = writePlane (o, facePlaneText (polygon_points, f), material, transform)
+    return o
+
+
+#
+#  roofPoints - verify and return the translated roof brick vertices.
+#
+
+def roofPoints (polygon_points):
     verify_polygon_points (polygon_points, "calc_face")
     polygon_points = translatePoints (polygon_points)
     verify_polygon_points (polygon_points, "calc_face")
-    for i, f in enumerate (faces):
-        vec, distance = calc_face (polygon_points[f[0]], polygon_points[f[1]], polygon_points[f[2]])
-        verify_plane_points (vec, distance, f, polygon_points)
-        o = plane (o, vec, distance, material, transform, "")
-    return o
+    return polygon_points
 
 
 #
-#  translatePoly - translate and return a list of vertices.
+#  exactOffset - return the minvec component, m, as a Decimal if the
+#                vertex component, p, is a Decimal.  Otherwise m is
+#                returned unchanged.
+#
+
+def exactOffset (p, m):
+    if isinstance (p, Decimal) and isinstance (m, float):
+        return Decimal (m)
+    return m
+
+
+#
+#  translatePoly - translate and return a list of vertices.  With
+#                  --exact a float component of minvec is coerced to
+#                  Decimal where it is subtracted from a Decimal vertex
+#                  component.
 #
 
 def translatePoly (vertices):
     result = []
     for v in vertices:
-        result += [translatePos (v)]
+        if args.exact:
+            result += [translatePos (v, [exactOffset (p, m) for p, m in zip (v, minvec)])]
+        else:
+            result += [translatePos (v)]
     return result
 
 
-def polybrick (o, polygon_points, faces, material, transform):
+#
+#  polyPoints - verify and return the translated polygon object vertices.
+#
+
+def polyPoints (polygon_points, faces):
     printf ("faces = %s\n", faces)
     printf ("vertices = %s\n", polygon_points)
     verify_polygon_points (polygon_points, "poly_brick_face before translate")
     polygon_points = translatePoly (polygon_points)
     verify_polygon_points (polygon_points, "poly_brick_face after translate")
+    return polygon_points
+
+
+def polybrick (o, polygon_points, faces, material, transform):
+    polygon_points = polyPoints (polygon_points, faces)
     for i, f in enumerate (faces):
         printf ("face no %d  %s\n", i, f)
-        vec, distance = calc_face (polygon_points[f[0]], polygon_points[f[1]], polygon_points[f[2]])
-        verify_plane_points (vec, distance, f, polygon_points)
-        o = plane (o, vec, distance, material, transform, "")
+        o = writePlane (o, facePlaneText (polygon_points, f), material, transform)
     return o
 
 
+#
+#  beginBrush - write the opening of a brushDef3 block preceeded by
+#               the comment line, comment.
+#
+
+def beginBrush (o, comment):
+    o.write ('    // ' + comment + '\n    {\n         brushDef3\n         {\n')
+    return o
+
+
+#
+#  endBrush - write the close of a brushDef3 block.
+#
+
+def endBrush (o):
+    o.write ('         }\n    }\n')
+    return o
+
+
+#
+#  cuboidBrush - write the brush of cuboid, k.  planes is unused.
+#
+
+def cuboidBrush (o, k, planes):
+    b = cuboids[k]
+    if args.debug:
+        print("cuboid", b.pos, "size", b.size)
+    o = beginBrush (o, 'cuboid ' + str (k))
+    o = brick (o, b.pos, b.end, b.material, b.transform, b.inches)
+    return endBrush (o)
+
+
 #
 #  flushCuboids - flush all the cuboid bricks which have the same fixed
 #                 value.
 #
 
 def flushCuboids (o, bcount, fixed):
-    for k in list (cuboids.keys ()):
-        b = cuboids[k]  # Python v2 and v3 compatible
-        if b.fixed == fixed:
-            if args.debug:
-                print("cuboid", b.pos, "size", b.size)
-            o.write ('    // cuboid ' + str (k) + '\n')
-            o.write ('    {\n')
-            o.write ('         brushDef3\n')
-            o.write ('         {\n')
-            o = brick (o, b.pos, b.end, b.material, b.transform)
-            o.write ('         }\n')
-            o.write ('    }\n')
-            bcount += 1
-    return o, bcount
+    keys = [k for k in list (cuboids.keys ()) if cuboids[k].fixed == fixed]
+    o = flushKind (o, 'cuboid', keys, None)
+    return o, bcount + len (keys)
+
+
+#
+#  useVectorPlanes - return True if the roof and polygon brick planes
+#                    should be computed in a single numpy batch.
+#
+
+def useVectorPlanes ():
+    return args.vectorise and chplanes.available ()
+
+
+#
+#  vectorPlanes - return the list of plane texts of each brick in,
+#                 bricks.  Each brick is a list of its translated
+#                 vertices and faces.  Lattice aligned faces are solved
+#                 exactly by cachedPlaneText, as in the serial path, and
+#                 only the remaining faces are solved and verified in
+#                 one batch by chplanes.
+#
+
+def vectorPlanes (bricks):
+    known, points, corners, owners = {}, [], [], []
+    result = []
+    for polygon_points, faces in bricks:
+        texts = []
+        for f in faces:
+            vertices = tuple (tuple (polygon_points[i]) for i in f)
+            if not (vertices in known):
+                if latticePlane (vertices, range (len (vertices))) == None:
+                    first = len (points)
+                    known[vertices] = len (corners)
+                    owners += [len (corners)] * len (vertices)
+                    corners += [[first, first + 1, first + 2]]
+                    points += vertices
+                else:
+                    known[vertices] = cachedPlaneText (vertices)
+            texts += [known[vertices]]
+        result += [texts]
+    if (points != []) and (max (max (p) for p in points) * inchesPerUnit >= maxd3Units):
+        error ("this map is too large, it must not exceed %d doom3 units square or %d pen units square\n", maxd3Units, maxd3Units / inchesPerUnit)
+    normals, distances, bad = chplanes.solveFaces (points, corners, owners,
+                                                   invertAxis (inchesPerUnit), 0.1)
+    for i in bad:
+        printf ("no point (p = %s) is not on plane: %s %s\n",
+                points[i], normals[owners[i]], distances[owners[i]])
+    if bad != []:
+        error ("the planes of %d brick faces do not pass through all their vertices\n",
+               len (set (owners[i] for i in bad)))
+    solved = [planeText (normals[j], distances[j]) for j in range (len (corners))]
+    for texts in result:
+        for i, t in enumerate (texts):
+            if isinstance (t, int):
+                texts[i] = solved[t]
+    return result
+
+
+#
+#  writePlaneTexts - write each plane text in, texts.
+#
+
+def writePlaneTexts (o, texts, material, transform):
+    for text in texts:
+        o = writePlane (o, text, material, transform)
+    return o
+
+
+#
+#  roofBrush - write the brush of roof brick, k.  planes is its list
+#              of plane texts or None if they should be solved here.
+#
+
+def roofBrush (o, k, planes):
+    b = roofBricks[k]
+    # print "roofbrick, polygon_points =", b.polygon_points, "material =", b.material
+    o = beginBrush (o, 'roof brick ' + str (k))
+    if planes == None:
+        o = roof (o, b.polygon_points, b.faces, b.material, b.transform)
+    else:
+        o = writePlaneTexts (o, planes, b.material, b.transform)
+    return endBrush (o)
 
 
 #
@@ -2624,18 +3122,32 @@ def flushCuboids (o, bcount, fixed):
 #
 
 def flushRoofBricks (o, bcount):
-    for k in list (roofBricks.keys ()):
-        b = roofBricks[k]
-        # print "roofbrick, polygon_points =", b.polygon_points, "material =", b.material
-        o.write ('    // roof brick ' + str (k) + "\n")
-        o.write ('    {\n')
-        o.write ('         brushDef3\n')
-        o.write ('         {\n')
-        o = roof (o, b.polygon_points, b.faces, b.material, b.transform)
-        o.write ('         }\n')
-        o.write ('    }\n')
-        bcount += 1
-    return o, bcount
+    keys = list (roofBricks.keys ())
+    planes = None
+    if useVectorPlanes ():
+        planes = vectorPlanes ([[roofPoints (roofBricks[k].polygon_points), roofBricks[k].faces]
+                                for k in keys])
+    o = flushKind (o, 'roof', keys, planes)
+    return o, bcount + len (keys)
+
+
+#
+#  polyBrush - write the brush of poly object, k.  planes is its list
+#              of plane texts or None if they should be solved here.
+#
+
+def polyBrush (o, k, planes):
+    b = polyobjs[k]
+    # sort_vertices ()
+    vert = b.polygon_points
+    faces = b.faces
+    # print "roofbrick, polygon_points =", b.polygon_points, "material =", b.material
+    o = beginBrush (o, 'polygon object ' + str (k) + " " + b.name)
+    if planes == None:
+        o = polybrick (o, vert, faces, b.material, b.transform)
+    else:
+        o = writePlaneTexts (o, planes, b.material, b.transform)
+    return endBrush (o)
 
 
 #
@@ -2643,31 +3155,179 @@ def flushRoofBricks (o, bcount):
 #
 
 def flushPolyObjects (o, bcount):
-    for k in list (polyobjs.keys ()):
-        b = polyobjs[k]
-        # sort_vertices ()
-        vert = b.polygon_points
-        faces = b.faces
-        # print "roofbrick, polygon_points =", b.polygon_points, "material =", b.material
-        o.write ('    // polygon object ' + str (k) + " " + b.name + "\n")
-        o.write ('    {\n')
-        o.write ('         brushDef3\n')
-        o.write ('         {\n')
-        o = polybrick (o, vert, faces, b.material, b.transform)
-        o.write ('         }\n')
-        o.write ('    }\n')
-        bcount += 1
-    return o, bcount
+    keys = list (polyobjs.keys ())
+    planes = None
+    if useVectorPlanes ():
+        planes = vectorPlanes ([[polyPoints (polyobjs[k].polygon_points, polyobjs[k].faces), polyobjs[k].faces]
+                                for k in keys])
+    o = flushKind (o, 'poly', keys, planes)
+    return o, bcount + len (keys)
+
+
+#
+#  brushWriters - the function which writes one brush of each kind.
+#
+
+brushWriters = {'cuboid': cuboidBrush,
+                'roof': roofBrush,
+                'poly': polyBrush}
+
+
+#
+#  writeBrushes - write the brushes of, kind, whose keys are listed
+#                 in, keys.  planes is None or the list of plane texts of
+#                 each brush.
+#
+
+def writeBrushes (o, kind, keys, planes):
+    for i, k in enumerate (keys):
+        if planes == None:
+            o = brushWriters[kind] (o, k, None)
+        else:
+            o = brushWriters[kind] (o, k, planes[i])
+    return o
+
+
+#
+#  brushesText - return the text of writeBrushes together with the
+#                number of plane cache hits and misses it caused.  It
+#                is run by the worker processes of brushPool whose
+#                caches are not seen by the parent.
+#
+
+def brushesText (kind, keys, planes):
+    before = cachedPlaneText.cache_info ()
+    text = writeBrushes (io.StringIO (), kind, keys, planes).getvalue ()
+    after = cachedPlaneText.cache_info ()
+    return text, after.hits - before.hits, after.misses - before.misses
+
+
+#
+#  flushKind - write the brushes of, kind, whose keys are listed in
+#              keys.  If a brushPool exists the keys are split into
+#              chunks which are formatted by the workers and the text
+#              is written in the original key order.  The plane
+#              cache hits and misses of the workers are added to
+#              workerCacheHits and workerCacheMisses.
+#
+
+def flushKind (o, kind, keys, planes):
+    global workerCacheHits, workerCacheMisses
+
+    if brushPool == None:
+        return writeBrushes (o, kind, keys, planes)
+    size = max (1, (len (keys) + brushChunks - 1) // brushChunks)
+    futures = []
+    for i in range (0, len (keys), size):
+        chunk = None
+        if planes != None:
+            chunk = planes[i:i+size]
+        futures += [brushPool.submit (brushesText, kind, keys[i:i+size], chunk)]
+    for f in futures:
+        text, hits, misses = f.result ()
+        o.write (text)
+        workerCacheHits += hits
+        workerCacheMisses += misses
+    return o
+
+
+#
+#  meshInches - return the list of [pos, end, inches] boxes found by
+#               greedyMesh for the cuboids, members.  If every member
+#               has whole inch corners the mesh is built from them with
+#               integer comparisons and each corner is mapped back to
+#               the pen position it came from.  Otherwise the pen
+#               positions are meshed and inches is None.
+#
+
+def meshInches (members):
+    if any (m.inches == None for m in members):
+        return [[pos, end, None] for pos, end in greedyMesh ([[m.pos, m.end] for m in members])]
+    pens = [{}, {}, {}]
+    for m in members:
+        for corner, inches in [[m.pos, m.inches[0]], [m.end, m.inches[1]]]:
+            for dim in range (3):
+                pens[dim].setdefault (inches[dim], corner[dim])
+    result = []
+    for lo, hi in greedyMesh ([m.inches for m in members]):
+        result += [[[pens[dim][lo[dim]] for dim in range (3)],
+                    [pens[dim][hi[dim]] for dim in range (3)],
+                    [lo, hi]]]
+    return result
+
+
+#
+#  meshCuboids - replace the fixed cuboids of each material, transform
+#                class by the boxes found by greedyMesh if this
+#                reduces the number of brushes.  The cuboids are
+#                renumbered in order and the non fixed cuboids (secret
+#                doors) are left untouched.
+#
+
+def meshCuboids ():
+    global cuboids, cuboidno, cuboidHash, meshedCuboids
+
+    classes = {}
+    for k in list (cuboids.keys ()):
+        b = cuboids[k]
+        if b.fixed:
+            classes.setdefault ((b.material, b.transform), []).append (b)
+    before = len (list (cuboids.keys ()))
+    old = cuboids
+    cuboids = {}
+    cuboidno = 1
+    cuboidHash = spatialHash ()
+    seen = {}
+    for k in list (old.keys ()):
+        b = old[k]
+        kind = (b.material, b.transform)
+        if not b.fixed:
+            addcuboid (b.pos, b.size, b.material, b.transform, b.fixed, b.inches)
+        elif not (kind in seen):
+            seen[kind] = True
+            members = classes[kind]
+            boxes = meshInches (members)
+            if len (boxes) < len (members):
+                for pos, end, inches in boxes:
+                    addcuboid (pos, subVec (end, pos), b.material, b.transform, True, inches)
+            else:
+                for m in members:
+                    addcuboid (m.pos, m.size, m.material, m.transform, m.fixed, m.inches)
+    meshedCuboids = before - len (list (cuboids.keys ()))
 
 
 #
 #  flushBricks - flushes all used fixed cuboids to the output file, o
+#                If --jobs is greater than one the brushes are formatted
+#                by a pool of worker processes.  The workers must be
+#                forked to inherit the bricks, so the brushes are written
+#                serially on platforms which cannot fork.
 #
 
+brushPool = None
+brushChunks = 1
+workerCacheHits = 0
+workerCacheMisses = 0
+
 def flushBricks (o, bcount):
-    o, bcount = flushCuboids (o, bcount, True)
-    o, bcount = flushRoofBricks (o, bcount)
-    o, bcount = flushPolyObjects (o, bcount)
+    global brushPool, brushChunks
+
+    if (args.jobs > 1) and ('fork' in multiprocessing.get_all_start_methods ()):
+        # the workers are forked with a copy of the bricks, anything
+        # still buffered must be written first or it would be repeated.
+        o.flush ()
+        sys.stdout.flush ()
+        brushPool = concurrent.futures.ProcessPoolExecutor (args.jobs,
+                                                            mp_context=multiprocessing.get_context ('fork'))
+        brushChunks = args.jobs * 4
+    try:
+        o, bcount = flushCuboids (o, bcount, True)
+        o, bcount = flushRoofBricks (o, bcount)
+        o, bcount = flushPolyObjects (o, bcount)
+    finally:
+        if brushPool != None:
+            brushPool.shutdown ()
+            brushPool = None
     return o, bcount
 
 
@@ -2719,8 +3379,9 @@ def brushFooter (o):
 def generateStepsVerticalWall (r, e, l):
     if args.debug:
         print("vertical steps in room", r, e)
-    leftLevel  = rooms[str (getFloor (e[0][0]-1, e[0][1]))].floorLevel
-    rightLevel = rooms[str (getFloor (e[0][0]+1, e[0][1]))].floorLevel
+    left, right = joinedRooms (e)
+    leftLevel  = rooms[str (left)].floorLevel
+    rightLevel = rooms[str (right)].floorLevel
     winc = 1.0/float (noSteps)
     if leftLevel == rightLevel:
         hinc = 0
@@ -2751,8 +3412,9 @@ def generateStepsVerticalWall (r, e, l):
 def generateStepsHorizontalWall (r, e, l):
     if args.debug:
         print("horizontal steps in room", r, e)
-    botLevel = rooms[str (getFloor (e[0][0], e[0][1]-1))].floorLevel
-    topLevel = rooms[str (getFloor (e[0][0], e[0][1]+1))].floorLevel
+    bot, top = joinedRooms (e)
+    botLevel = rooms[str (bot)].floorLevel
+    topLevel = rooms[str (top)].floorLevel
     winc = 1.0/float (noSteps)
     if topLevel == botLevel:
         hinc = 0
@@ -3421,17 +4083,40 @@ def findOffsetInRoom (r):
 #
 
 def findOffsets ():
-    global minvec
+    global minvec, minInches
     for r in list(rooms.keys ()):
         findOffsetInRoom (r)
     minvec = [minx, miny, minz]
+    minInches = fixedVec (minvec)
 
 
 #
-#  initRoomFloor -
+#  indexRoomCells - return a dictionary mapping each room number to the
+#                   list of its floor cells.  Only the bounding box
+#                   recorded when the room was flooded is scanned.
+#
+
+def indexRoomCells ():
+    result = {}
+    for r in list(rooms.keys ()):
+        box = rooms[r].floorBox
+        if box != None:
+            result[int (r)] = floor.positions (int (r),
+                                               max (box[0][0], 1), min (box[1][0], maxx-1),
+                                               max (box[0][1], 1), min (box[1][1], maxy-1))
+    return result
+
+
+#
+#  initRoomFloor - plot the walls and flood the floor of every room.
+#                  Once complete the per room cell index, roomCells,
+#                  is built so the floor and ceiling generators only
+#                  visit the cells of their own room, and the door cell
+#                  index, doorCells, is built for onDoor and the doorway steps.
 #
 
 def initRoomFloor ():
+    global roomCells, doorCells
     initFloor (maxx, maxy, emptyValue)
     for r in list(rooms.keys ()):
         for w in rooms[r].walls:
@@ -3439,9 +4124,11 @@ def initRoomFloor ():
         if rooms[r].inside == None:
             error ('room %d must have an inside position', int (r))
         else:
-            floodFloor (int (r), intVec (rooms[r].inside))
+            rooms[r].floorBox = floodFloor (int (r), intVec (rooms[r].inside))
+    roomCells = indexRoomCells ()
+    doorCells = indexDoors ()
     if args.debug:
-        for f in floor:
+        for f in floor.rows ():
             print(f)
 
 def candleCeil (r, x, y, z):
@@ -3694,14 +4381,15 @@ def inBetween (c, a, b):
 
 
 #
-#  onDoor - return True if point, x, y, is on a door in room, r.
+#  onDoor - return True if point, x, y, is on a door in any room.
+#           Only the doors covering x, y in doorCells are tested.
 #
 
 def onDoor (x, y):
     if args.debug:
         print("is", x, y, "on a door")
-    for r in list(rooms.keys ()):
-        for d in rooms[r].doors:
+    if (x, y) in doorCells:
+        for r, d, sides in doorCells[(x, y)]:
             coords = d[0]
             if coords[0][0] == coords[1][0]:
                 # vertical
@@ -3782,6 +4470,17 @@ def generateBeams (r, e):
                 makeCandleYapex (r, x0, x1, y)
 
 
+#
+#  getRoomCells - return the list of [x, y] floor positions of room, r,
+#                 ordered by x and then y.
+#
+
+def getRoomCells (r):
+    if int (r) in roomCells:
+        return roomCells[int (r)]
+    return []
+
+
 #
 #  generateFlatCeiling - generate a simple flat surface (slab) at
 #                        rooms[roomNo].floorLevel+minCeilingHeight .. minCeilingHeight
@@ -3789,13 +4488,11 @@ def generateBeams (r, e):
 #
 
 def generateFlatCeiling (roomNo, e):
-    for x in range (1, maxx):
-        for y in range (1, maxy):
-            if getFloor (x, y) == int (roomNo):
-                pos = [x, y, getFloorLevel (roomNo) + minCeilingHeight]
-                end = [x+1, y+1, getFloorLevel (roomNo) + minCeilingHeight + 1.0]
-                size = subVec (end, pos)
-                newcuboid (pos, size, 'ceiling', roomNo)
+    for x, y in getRoomCells (roomNo):
+        pos = [x, y, getFloorLevel (roomNo) + minCeilingHeight]
+        end = [x+1, y+1, getFloorLevel (roomNo) + minCeilingHeight + 1.0]
+        size = subVec (end, pos)
+        newcuboid (pos, size, 'ceiling', roomNo)
 
 
 def apply_translate_top (points, translate_top, z_value):
@@ -3957,9 +4654,10 @@ def generatePitchedCeiling (r, e):
 
 
 def testFaces (r):
-    global cuboidno, cuboids
+    global cuboidno, cuboids, cuboidHash
     cuboidno = 1          #  total number of cuboids used.
     cuboids = {}
+    cuboidHash = spatialHash ()
     if False:
         pos = [1, 1, 1]
         end = [2, 2, 2]
@@ -3986,14 +4684,12 @@ def generateCeiling (roomNo, e):
 
 def generateFloor (r, e):
     global minFloor, maxFloor
-    for x in range (1, maxx):
-        for y in range (1, maxy):
-            if getFloor (x, y) == int (r):
-                pos = [x, y, minFloor-1]
-                size = [1, 1, rooms[r].floorLevel-minFloor+1]
-                if args.debug:
-                    print("floor at", pos, size)
-                newcuboid (pos, size, 'floor', r)
+    for x, y in getRoomCells (r):
+        pos = [x, y, minFloor-1]
+        size = [1, 1, rooms[r].floorLevel-minFloor+1]
+        if args.debug:
+            print("floor at", pos, size)
+        newcuboid (pos, size, 'floor', r)
 
 #
 #  generateLimits - output the pen and doom map limits.
@@ -4054,6 +4750,10 @@ def generateEntities (o):
                 generateSimpleStairs (roomNo)
             popScope ()
     vprintf ("\n")
+    if args.optimize >= 2:
+        vprintf ("brick meshing...")
+        meshCuboids ()
+        vprintf ("done\n")
     vprintf ("brick optimisation...")
     o, bcount = flushBricks (o, bcount)
     vprintf ("done\n")
@@ -4138,13 +4838,16 @@ def pen2Pos (pos):
 
 #
 #  translatePos - pre-condition:   pos is a list of numbers (3D pen coordinates).
-#                 post-condition:  returns pos - minvec.
+#                                  offset is minvec unless it is given.
+#                 post-condition:  returns pos - offset.
 #
 
-def translatePos (pos):
+def translatePos (pos, offset = None):
+    if offset == None:
+        offset = minvec
     if args.debug:
-        print("translatePos called for", pos, minvec, "=", end=' ')
-    pos = subVec (pos, minvec)
+        print("translatePos called for", pos, offset, "=", end=' ')
+    pos = subVec (pos, offset)
     pos = [pos[0], pos[1], -pos[2]]
     return pos
 
@@ -4198,7 +4901,7 @@ def generatePlayer (o, player_entity):
             xyz = toIntList (xy) + [-invSpawnHeight]
             xyz = subVec (xyz, [minx, miny, getFloorLevel (r) + getPlinthHeight (r, xy[0], xy[1])])
             v = midReposition (xyz)
-            o.write ('%f %f %f"\n' % (v[0], v[1], v[2]))
+            o.write (originText (v) + '"\n')
             o.write ('    "angle" "180"\n')
             o.write ("}\n")
             player_entity += 1
@@ -4208,30 +4911,32 @@ def generatePlayer (o, player_entity):
 def generateLights (o, e):
     n = 1
     for p, l in lightPoints:
-        o.write ("// entity " + str (e) + '\n')
-        o.write ("{\n")
-        o.write ('    "classname" "light"\n')
-        o.write ('    "name" "light_' + str (n) + '"\n')
-        o.write ('    "origin" "')
-        l.writeLightSource (o, p)
-        o.write ('    "noshadows" "0"\n')
-        o.write ('    "nospecular" "0"\n')
-        o.write ('    "nodiffuse" "0"\n')
+        block = io.StringIO ()
+        block.write ("// entity " + str (e) + '\n')
+        block.write ("{\n")
+        block.write ('    "classname" "light"\n')
+        block.write ('    "name" "light_' + str (n) + '"\n')
+        block.write ('    "origin" "')
+        l.writeLightSource (block, p)
+        block.write ('    "noshadows" "0"\n')
+        block.write ('    "nospecular" "0"\n')
+        block.write ('    "nodiffuse" "0"\n')
         if l.getOn () == "FLOOR":
-            o.write ('    "falloff" "0.5"\n')
-            o.write ('    "texture" "lights/round_flicker"\n')
-            o.write ('    "_color" "')
-            l.write (o)
-            o.write ('"\n')
-            o.write ('    "light_radius" "36 36 36"\n')
+            block.write ('    "falloff" "0.5"\n')
+            block.write ('    "texture" "lights/round_flicker"\n')
+            block.write ('    "_color" "')
+            l.write (block)
+            block.write ('"\n')
+            block.write ('    "light_radius" "36 36 36"\n')
         else:
-            o.write ('    "falloff" "0.0"\n')
-            o.write ('    "texture" "lights/round_flicker"\n')
-            o.write ('    "_color" "')
-            l.write (o)
-            o.write ('"\n')
-            o.write ('    "light_radius" "225 225 225"\n')
-        o.write ("}\n")
+            block.write ('    "falloff" "0.0"\n')
+            block.write ('    "texture" "lights/round_flicker"\n')
+            block.write ('    "_color" "')
+            l.write (block)
+            block.write ('"\n')
+            block.write ('    "light_radius" "225 225 225"\n')
+        block.write ("}\n")
+        o.write (block.getvalue ())
         n += 1
         e += 1
     return o, e
@@ -4695,7 +5400,7 @@ def generatePythonMonsters (o, e):
             xyz = toIntList (xy) + [-invSpawnHeight]
             xyz = subVec (xyz, [minx, miny, getFloorLevel (r) + getPlinthHeight (r, xy[0], xy[1])])
             v = midReposition (xyz)
-            o.write ('%f %f %f"\n' % (v[0], v[1], v[2]))
+            o.write (originText (v) + '"\n')
             o.write ('    "ambush" "1"\n')
             o.write ("}\n")
             n += 1
@@ -4707,18 +5412,17 @@ def generateMonsters (o, e):
     n = 1
     for r in list(rooms.keys()):
         for monster, xy in rooms[r].monsters:
-            o.write ("// entity " + str (e) + '\n')
-            o.write ("{\n")
-            o.write ('    "classname" "' + monster + '"\n')
-            o.write ('    "name" "' + monster + '_' + str (n) + '"\n')
-            o.write ('    "anim" "idle"\n')
-            o.write ('    "origin" "')
             xyz = toIntList (xy) + [-invSpawnHeight]
             xyz = subVec (xyz, [minx, miny, getFloorLevel (r) + getPlinthHeight (r, xy[0], xy[1])])
             v = midReposition (xyz)
-            o.write ('%f %f %f"\n' % (v[0], v[1], v[2]))
-            o.write ('    "ambush" "1"\n')
-            o.write ("}\n")
+            o.write (''.join (["// entity ", str (e), '\n',
+                               "{\n",
+                               '    "classname" "', monster, '"\n',
+                               '    "name" "', monster, '_', str (n), '"\n',
+                               '    "anim" "idle"\n',
+                               '    "origin" "', originText (v), '"\n',
+                               '    "ambush" "1"\n',
+                               "}\n"]))
             n += 1
             e += 1
     return o, e
@@ -4740,7 +5444,7 @@ def generateAmmo (o, entno):
             xyz = subVec (xyz, [minx, miny,
                                 getFloorLevel (room) + getPlinthHeight (room, xy[0], xy[1])])
             v = midReposition (xyz)
-            o.write ('%f %f %f"\n' % (v[0], v[1], v[2]))
+            o.write (originText (v) + '"\n')
             o.write ("}\n")
             n += 1
             entno += 1
@@ -4761,7 +5465,7 @@ def generateSounds (o, e):
             xyz = toIntList (xy) + [-invSpawnHeight]
             xyz = subVec (xyz, [minx, miny, getFloorLevel (r) + getPlinthHeight (r, xy[0], xy[1])])
             v = midReposition (xyz)
-            o.write ('%f %f %f"\n' % (v[0], v[1], v[2]))
+            o.write (originText (v) + '"\n')
             o.write ('    "s_shader" "%s"\n' % s.filename)
             o.write ('    "s_mindistance" "%s"\n' % s.mindist)
             o.write ('    "s_maxdistance" "%s"\n' % s.maxdist)
@@ -4797,7 +5501,7 @@ def generateWeapons (o, e):
             xyz = toIntList (xy) + [-invSpawnHeight]
             xyz = subVec (xyz, [minx, miny, getFloorLevel (r) + getPlinthHeight (r, xy[0], xy[1])])
             v = midReposition (xyz)
-            o.write ('%f %f %f"\n' % (v[0], v[1], v[2]))
+            o.write (originText (v) + '"\n')
             o.write ("}\n")
             n += 1
             e += 1
@@ -4819,7 +5523,7 @@ def generateLabels (o, e):
             xyz = toIntList (xy) + [-invSpawnHeight]
             xyz = subVec (xyz, [minx, miny, getFloorLevel (r) + getPlinthHeight (r, xy[0], xy[1])])
             v = midReposition (xyz)
-            o.write ('%f %f %f"\n' % (v[0], v[1], v[2]))
+            o.write (originText (v) + '"\n')
             o.write ("}\n")
             n += 1
             e += 1
@@ -4877,6 +5581,11 @@ def generateMap (o):
         print("Total rooms =", len (list (rooms.keys ())))
         print("Total cuboids =", len (list (cuboids.keys ())))
         print("Total cuboids expanded (optimised) =", getexpanded ())
+        if args.optimize >= 2:
+            print("Total cuboids removed by meshing =", meshedCuboids)
+        info = cachedPlaneText.cache_info ()
+        print("Total plane cache hits =", info.hits + workerCacheHits,
+              "misses =", info.misses + workerCacheMisses)
         print("Total entities used =", e, "entities unused =", maxEntities-e)
         print("Total brushes used  =", b)
     return o
@@ -4913,71 +5622,71 @@ def getNeighbours (r):
 
 
 #
-#  getVirtualNeighbours - return the neighbouring rooms for room, r.
-#                         A virtual neighbour will never have an adjoining secret door.
+#  roomGraph - return the graph of rooms used to assign floor levels.
+#              Rooms joined by secret doors share a floor level so
+#              they are merged by union find into a single node, named
+#              after one of its rooms.  It returns cluster, members and
+#              adjacent.  cluster maps each room to its node, members
+#              maps each node to its list of rooms and adjacent maps
+#              each node to the set of other nodes reached through its
+#              ordinary doors.
 #
 
-def getVirtualNeighbours (r):
-    # print ("getVirtualNeighbours =", r)
-    virtList = getVirtualRoom (r)
-    # print ("virtual room", virtList)
-    n = []
-    for i in virtList:
-        r = rooms[i]
-        for d in r.doors:
-            if d[2] != status_secret:
-                if (not (d[1] in virtList)) and (not (d[1] in n)):
-                    n += [d[1]]
-    # print ("virtual neighbours", n)
-    return n
-
+def roomGraph ():
+    parent = {}
 
-#
-#  getVirtualRoom - return a list of rooms which are rooms connected by secret doors.
-#
+    def find (r):
+        parent.setdefault (r, r)
+        while parent[r] != r:
+            parent[r] = parent[parent[r]]
+            r = parent[r]
+        return r
 
-def getVirtualRoom (r):
-    todo = [r]
-    # print ("todo =", todo)
-    visited = []
-    virtualRoomList = [r]
-    while todo != []:
-        nextTodo = []
-        for r in todo:
-            if not (r in visited):
-                visited += [r]
-                # print ("r =", r)
-                for c in todo:
-                    for d in rooms[r].doors:
-                        if d[2] == status_secret:
-                            if not (d[1] in virtualRoomList):
-                                virtualRoomList += [d[1]]
-                            if not (d[1] in visited):
-                                nextTodo += [d[1]]
-        todo = nextTodo
-    return virtualRoomList
+    for r in list (rooms.keys ()):
+        for d in rooms[r].doors:
+            if d[2] == status_secret:
+                a, b = find (r), find (d[1])
+                if a != b:
+                    parent[b] = a
+    cluster = {}
+    members = {}
+    for r in list (rooms.keys ()):
+        cluster[r] = find (r)
+        members.setdefault (cluster[r], [])
+        members[cluster[r]] += [r]
+    adjacent = {}
+    for r in list (rooms.keys ()):
+        adjacent.setdefault (cluster[r], set ())
+        for d in rooms[r].doors:
+            if d[2] != status_secret:
+                n = find (d[1])
+                if n != cluster[r]:
+                    adjacent[cluster[r]].add (n)
+    return cluster, members, adjacent
 
 
 #
-#  lowerFloors - starting at room, s, lower all neighbouring floors
+#  lowerFloors - starting at node, s, of the room graph lower all
+#                neighbouring floors one level per door passed through.
 #                This is a breadth first algorithm.
 #
 
-def lowerFloors (s):
-    visited = [s]
-    queue = getVirtualNeighbours (s)
-    level = -(floorStep * noSteps)
+def lowerFloors (s, members, adjacent):
+    visited = {s}
+    queue = [s]
+    level = 0
     while queue != []:
+        level -= (floorStep * noSteps)
         nextLevel = []
         for c in queue:
-            roomList = getVirtualRoom (c)
-            for i in roomList:
-                r = rooms[i]
-                if r.floorLevel == None:
-                    r.floorLevel = level
-                    nextLevel += getVirtualNeighbours (i)
+            for n in adjacent[c]:
+                if not (n in visited):
+                    visited.add (n)
+                    nextLevel += [n]
+                    for i in members[n]:
+                        if rooms[i].floorLevel == None:
+                            rooms[i].floorLevel = level
         queue = nextLevel
-        level -= (floorStep * noSteps)
 
 
 #
@@ -4986,9 +5695,11 @@ def lowerFloors (s):
 
 def calcFloorLevel ():
     global minFloor, maxFloor
-    for s in getVirtualRoom (getSpawnRoom ()):
+    cluster, members, adjacent = roomGraph ()
+    spawn = cluster[getSpawnRoom ()]
+    for s in members[spawn]:
         rooms[s].floorLevel = 0
-    lowerFloors (getSpawnRoom ())
+    lowerFloors (spawn, members, adjacent)
     for r in list (rooms.keys ()):
         if debugFloorLevel:
             print ("room", r, "has floor level", end=' ')
@@ -5013,9 +5724,23 @@ def checkRegression ():
         regressiontest ()
     setOptimise (optimise)
     unit_tests ()
+    textCacheTests ()
     dump_unit_coords ()
 
 
+#
+#  textCacheTests - check that values which compare equal but are
+#                   shown differently are given their own cached text.
+#
+
+def textCacheTests ():
+    assert (fixedText (0.0) == '0.000000')
+    assert (fixedText (-0.0) == '-0.000000')
+    assert (fixedText (0.0) == '0.000000')
+    assert (unitText (Decimal ('1.50')) == '1.50')
+    assert (unitText (Decimal ('1.5')) == '1.5')
+
+
 def dump_unit_coords ():
     toppos = [1, 1, 1]
     botpos = [0, 0, 0]
@@ -5038,26 +5763,27 @@ def dump_unit_coords ():
 #
 
 def main ():
-    global words, args
+    global tokens, args
     args = initOptions ()
+    set_exact (args.exact)
     checkRegression ()
     if args.inputfile == '-':
         # input file not set so use stdin
         inf = sys.stdin
     else:
         inf = open (args.inputfile, 'r')
-    if args.outputfile == '-':
-        # output file not set so use stdout
-        opf = sys.stdout
-    else:
-        opf = open (args.outputfile, 'w')
-    words = lexicalPen (inf)
-    if parsePen ():
-        if args.txt:
-            opf = generateTxt (opf)
-        else:
-            opf = generateMap (opf)
-        opf.flush ()
+    # output file - is stdout and a .gz or .xz suffix compresses the output
+    opf = openMap (args.outputfile)
+    tokens = penLexer (inf)
+    try:
+        if parsePen ():
+            if args.txt:
+                opf = generateTxt (opf)
+            else:
+                opf = generateMap (opf)
+    finally:
+        # write out any partial map even if an error occurred.
+        opf.close ()
 
 
 main ()
@@ -24,6 +24,7 @@
 
 import getopt, sys, string
 from chvec import *
+from chlex import penLexer
 
 
 """
@@ -68,8 +69,7 @@ rooms = {}
 maxx, maxy = 0, 0
 doorValue, wallValue, emptyValue = 0, -1, -2
 versionNumber = "0.1"
-currentLineNo = 1
-words = []
+tokens = None
 curStatus = None
 status_open, status_closed, status_secret, status_visportal = list(range(4))
 doorString = ['OPEN', 'CLOSED', 'SECRET', 'VISPORTAL']
@@ -406,8 +406,8 @@ def handleOptions ():
 
 
 def errorLine (text):
-    global inputFile, currentLineNo
-    full = "%s:%d:%s\n" % (inputFile, currentLineNo, text)
+    global inputFile
+    full = "%s:%d:%s\n" % (inputFile, tokens.lineNo, text)
     print(full)
     sys.stderr (full)
 
@@ -483,46 +483,20 @@ def findDoors (r, p):
                 rooms[r].doorLeadsTo += [getFloor (d[0][0], d[0][1]-1)]
 
 
-def doGetToken ():
-    global words
-    if len (words) > 1:
-        return words[0], words[1:]
-    elif len (words) == 1:
-        return words[0], ['<eof>']
-
-
-def expectEoln ():
-    global currentLineNo, words
-    if words[0] == '<eoln>':
-        currentLineNo += 1
-        words = words[1:]
-
-
 #
-#  get - returns the next token and the remainder of the words.
+#  get - returns the next token.
 #
 
 def get ():
-    global currentLineNo, words
-    n, words = doGetToken ()
-    while n == '<eoln>':
-        expectEoln ()
-        n, words = doGetToken ()
-    return n
+    return tokens.get ()
 
 
 #
 #  peek - returns the first token without removing it from input.
-#         It will advance the linenumber if <eoln> is seen.
 #
 
 def peek ():
-    global currentLineNo, words
-    n = words[0]
-    while n == '<eoln>':
-        expectEoln ()
-        return peek ()
-    return n
+    return tokens.peek ()
 
 
 #
@@ -559,25 +533,6 @@ def expecting (l):
     return t in l
 
 
-#
-#  lexicalPen - return a list of tokens to be read by the parser.
-#               A special token <eoln> is added at the end of each line.
-#               <eof> is added at the end.
-#
-
-def lexicalPen (i):
-    words = []
-    for l in i.readlines ():
-        w = l.split ()
-        w += ['<eoln>']
-        for j in w:
-            if j != "":
-                i = j.rstrip ()
-                words += [i]
-    words += ['<eof>']
-    return words
-
-
 def wallCoords ():
     global curRoom
     if integer ():
@@ -2069,7 +2024,7 @@ def placeRoomsOnFloor ():
 #
 
 def main ():
-    global inputFile, words, toTxt
+    global inputFile, tokens, toTxt
     io = handleOptions ()
     if (io[0] == None) or (io[0] == '-'):
         # input file not set so use stdin
@@ -2084,7 +2039,7 @@ def main ():
     else:
         o = open (io[1], 'w')
 
-    words = lexicalPen (i)
+    tokens = penLexer (i)
     if parsePen ():
         placeRoomsOnFloor ()
         if convexTransform:
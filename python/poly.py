@@ -28,6 +28,7 @@ import math
 from decimal import Decimal
 
 epsilon = 0.0001
+exact = False     # use Decimal rather than float components, see set_exact.
 
 #
 #  printf - keeps C programmers happy :-)
@@ -56,257 +57,193 @@ def is_near (a, b):
         return is_near (a, float (b))
     return a == b
 
+
+#
+#  set_exact - when value is True all subsequently created vec and mat
+#              components are held as Decimal rather than float.  The
+#              pen2map --exact option uses it.  Float rounding can land
+#              a rotated vertex exactly on the inch lattice, so a few
+#              planes differ between the modes, for example 336 rather
+#              than 336.0000000000000110218200000 in maps/stairs.txt.
+#
+
+def set_exact (value):
+    global exact
+
+    exact = value
+
+
+#
+#  _number - return value as a float, or as a Decimal in exact mode.
+#
+
+def _number (value):
+    if exact:
+        return Decimal (value)
+    return float (value)
+
+
+#
+#  _string - return the decimal expansion of component, value.
+#            Floats are shown exactly as a Decimal would show them
+#            so that the debugging output does not depend upon the mode.
+#
+
+def _string (value):
+    return str (Decimal (value))
+
+
+#
+#  vec - a vector of three or four components held in a tuple.
+#
+
 class vec:
+    __slots__ = ('_v',)
     def __init__ (self, x, y, z, a=None):
-        print ("vec __init__")
-        self._x = Decimal (x)
-        self._y = Decimal (y)
-        self._z = Decimal (z)
         if a is None:
-            self._dim = 3
-            self._a = None
+            self._v = (_number (x), _number (y), _number (z))
         else:
-            self._a = Decimal (a)
-            self._dim = 4
+            self._v = (_number (x), _number (y), _number (z), _number (a))
     def is_matrice (self):
         return False
     def is_vec (self):
         return True
     def __str__ (self):
-        s = "vec (" + str (self._x)
-        s += ', '
-        s += str (self._y)
-        s += ', '
-        s += str (self._z)
-        if self._a != None:
-            s += ', '
-            s += str (self._a)
-        s += ')'
-        return s
+        return "vec (" + ", ".join ([_string (e) for e in self._v]) + ")"
     def to_list (self, length = None):
-        result = [self._x, self._y, self._z]
-        if self._a != None:
-            result += [self._a]
-        return result
+        return list (self._v)
     def dup (self):
-        return vec (self._x, self._y, self._z, self._a)
+        result = vec.__new__ (vec)
+        result._v = self._v
+        return result
     def length (self):
-        return self._dim
+        return len (self._v)
     def extend (self, length, value):
-        if self._dim < length:
-            self._a = value
-            self._dim += 1
+        if len (self._v) < length:
+            self._v += (_number (value),)
         return self
     def element (self, idx):
-        if idx < self._dim:
-            if idx == 0:
-                return self._x
-            if idx == 1:
-                return self._y
-            if idx == 2:
-                return self._z
-            if idx == 3:
-                return self._a
-        print (self, "idx =", idx, self._dim)
+        if idx < len (self._v):
+            return self._v[idx]
+        print (self, "idx =", idx, len (self._v))
         error ("vec[idx] is out of bounds")
     def set_element (self, idx, value):
-        value = Decimal (value)
-        if idx < self._dim:
-            if idx == 0:
-                self._x = value
-            if idx == 1:
-                self._y = value
-            if idx == 2:
-                self._z = value
-            if idx == 3:
-                self._a = value
+        if idx < len (self._v):
+            v = list (self._v)
+            v[idx] = _number (value)
+            self._v = tuple (v)
             return self
-        print (self, "idx =", idx, self._dim)
+        print (self, "idx =", idx, len (self._v))
         error ("vec[idx] is out of bounds")
     def init (self, value):
-        value = Decimal (value)
-        self._x = value
-        self._y = value
-        self._z = value
-        if self._dim == 4:
-            self._a = value
+        self._v = (_number (value),) * len (self._v)
         return self
     def mult_vec (self, other):
         if self.length () != other.length ():
             error ("cannot multiply different vector lengths")
-        result = self.dup ()
-        result.init (0)
-        print ("mult_vec start =", self)
-        for idx in range (self.length ()):
-            result.set_element (idx, self.element (idx) * other.element (idx))
-        print ("mult_vec end =", self)
-        print ("mult_vec result =", result)
+        result = vec.__new__ (vec)
+        result._v = tuple ([a * b for a, b in zip (self._v, other._v)])
         return result
     #
     #  mult_mat - multiply vector self by matrice mat.
+    #             The whole 4x4 transform is applied in one step.
     #
     def mult_mat (self, mat):
         assert (mat.is_matrice ())
-        vector = self.dup ()
-        print ("vector in mult_mat", vector)
-        self.init (0)
-        xprime = (vector.element (0) * mat.element (0, 0) +
-                  vector.element (1) * mat.element (1, 0) +
-                  vector.element (2) * mat.element (2, 0) +
-                  mat.element (3, 0))
-        self.set_element (0, xprime)
-        yprime = (vector.element (0) * mat.element (0, 1) +
-                  vector.element (1) * mat.element (1, 1) +
-                  vector.element (2) * mat.element (2, 1) +
-                  mat.element (3, 1))
-        self.set_element (1, yprime)
-        zprime = (vector.element (0) * mat.element (0, 2) +
-                  vector.element (1) * mat.element (1, 2) +
-                  vector.element (2) * mat.element (2, 2) +
-                  mat.element (3, 2))
-        self.set_element (2, zprime)
-        print ("finished vec", self)
+        x, y, z = self._v[0], self._v[1], self._v[2]
+        e = mat._elements
+        d = mat._dim
+        t = 3 * d
+        v = (x * e[0] + y * e[d] + z * e[2 * d] + e[t],
+             x * e[1] + y * e[d + 1] + z * e[2 * d + 1] + e[t + 1],
+             x * e[2] + y * e[d + 2] + z * e[2 * d + 2] + e[t + 2])
+        if len (self._v) == 4:
+            v += (_number (0),)
+        self._v = v
         return self
     def __eq__ (self, other):
-        if other == None:
-            return False
-        if self.length () != other.length ():
+        if other is None:
             return False
-        if not is_near (self._x, other._x):
-            return False
-        if not is_near (self._y, other._y):
-            return False
-        if not is_near (self._z, other._z):
-            return False
-        if not is_near (self._a, other._a):
+        if len (self._v) != len (other._v):
             return False
+        for a, b in zip (self._v, other._v):
+            if not is_near (a, b):
+                return False
         return True
     def __ne__ (self, other):
-        if other == None:
-            return True
-        if self.length () != other.length ():
-            return True
-        if not is_near (self._x, other._x):
-            return True
-        if not is_near (self._y, other._y):
-            return True
-        if not is_near (self._z, other._z):
-            return True
-        if not is_near (self._a, other._a):
-            return True
-        return False
+        return not self.__eq__ (other)
     def scale (self, factor):
-        self._x *= factor
-        self._y *= factor
-        self._z *= factor
-        if self._a != None:
-            self._a *= factor
+        factor = _number (factor)
+        self._v = tuple ([e * factor for e in self._v])
         return self
     def __add__ (self, other):
-        if self._dim == other._dim:
-            if self._dim == 3:
-                return vec (self._x + other._x,
-                            self._y + other._y,
-                            self._z + other._z)
-            elif self._dim == 4:
-                return vec (self._x + other._x,
-                            self._y + other._y,
-                            self._z + other._z,
-                            self._a + other._a)
+        if len (self._v) == len (other._v):
+            result = vec.__new__ (vec)
+            result._v = tuple ([a + b for a, b in zip (self._v, other._v)])
+            return result
         error ("can only add vectors of the same size")
     def __sub__ (self, other):
-        if self._dim == other._dim:
-            if self._dim == 3:
-                return vec (self._x - other._x,
-                            self._y - other._y,
-                            self._z - other._z)
-            elif self._dim == 4:
-                return vec (self._x - other._x,
-                            self._y - other._y,
-                            self._z - other._z,
-                            self._a - other._a)
+        if len (self._v) == len (other._v):
+            result = vec.__new__ (vec)
+            result._v = tuple ([a - b for a, b in zip (self._v, other._v)])
+            return result
         error ("can only sub vectors of the same size")
     def __neg__ (self):
-        if self._dim == 3:
-            return vec (-self._x, -self._y, -self._z)
-        elif self._dim == 4:
-            return vec (-self._x, -self._y, -self._z, -self._a)
+        result = vec.__new__ (vec)
+        result._v = tuple ([-e for e in self._v])
+        return result
+
+
+#
+#  mat - a square matrice of dimension 3 or 4.  The elements are held
+#        in a flat list, column after column, so element (col, row) is
+#        _elements[col * _dim + row].
+#
+
 class mat:
+    __slots__ = ('_dim', '_elements')
     def __init__ (self, x, y = None, z = None, a = None):
         if y is None:
             self._dim = x
-            if x == 3:
-                self._x = vec (Decimal (0.0), Decimal (0.0), Decimal (0.0))
-                self._y = vec (Decimal (0.0), Decimal (0.0), Decimal (0.0))
-                self._z = vec (Decimal (0.0), Decimal (0.0), Decimal (0.0))
-                self._a = None
-            else:
-                self._x = vec (Decimal (0.0), Decimal (0.0), Decimal (0.0), Decimal (0.0))
-                self._y = vec (Decimal (0.0), Decimal (0.0), Decimal (0.0), Decimal (0.0))
-                self._z = vec (Decimal (0.0), Decimal (0.0), Decimal (0.0), Decimal (0.0))
-                self._a = vec (Decimal (0.0), Decimal (0.0), Decimal (0.0), Decimal (0.0))
+            self._elements = [_number (0)] * (x * x)
         else:
-            self._x = x.dup ()
-            self._y = y.dup ()
-            self._z = z.dup ()
-            if a == None:
-                self._a = None
-                self._dim = 3
-            else:
-                self._a = a.dup ()
-                self._dim = 4
+            columns = [x, y, z]
+            if a != None:
+                columns += [a]
+            self._dim = len (columns)
+            self._elements = []
+            for column in columns:
+                self._elements += column.to_list ()
     def is_matrice (self):
         return True
     def is_vec (self):
         return False
+    def _column (self, col):
+        result = vec.__new__ (vec)
+        result._v = tuple (self._elements[col * self._dim:(col + 1) * self._dim])
+        return result
     def __str__ (self):
         s = "mat ("
-        s += str (self._x)
-        s += ", "
-        s += str (self._y)
-        s += ", "
-        s += str (self._z)
-        if self._a != None:
-            s += ", "
-            s += str (self._a)
+        s += ", ".join ([str (self._column (col)) for col in range (self._dim)])
         s += ")"
         return s
     def init (self, value):
-        self._x.init (value)
-        self._y.init (value)
-        self._z.init (value)
-        if self._a != None:
-            self._a.init (value)
+        self._elements = [_number (value)] * (self._dim * self._dim)
     def identity (self):
         self.init (0)
-        self._x.set_element (0, 1.0)
-        self._y.set_element (1, 1.0)
-        self._z.set_element (2, 1.0)
-        if self._a != None:
-            self._a.set_element (3, 1.0)
-        print ("after identify", self)
+        for d in range (self._dim):
+            self._elements[d * self._dim + d] = _number (1)
     def length (self):
         return self._dim
     def dup (self):
-        return mat (self._x, self._y, self._z, self._a)
+        result = mat.__new__ (mat)
+        result._dim = self._dim
+        result._elements = list (self._elements)
+        return result
     def element (self, col, row):
-        if col == 0:
-            return self._x.element (row)
-        if col == 1:
-            return self._y.element (row)
-        if col == 2:
-            return self._z.element (row)
-        if col == 3:
-            return self._a.element (row)
+        return self._elements[col * self._dim + row]
     def set_element (self, col, row, value):
-        if col == 0:
-            self._x.set_element (row, Decimal (value))
-        if col == 1:
-            self._y.set_element (row, Decimal (value))
-        if col == 2:
-            self._z.set_element (row, Decimal (value))
-        if col == 3:
-            self._a.set_element (row, Decimal (value))
+        self._elements[col * self._dim + row] = _number (value)
     def mult_vec (self, vec):
         assert (vec.is_vec ())
         result = self.dup ()
@@ -322,48 +259,30 @@ class mat:
         return result
     def mult_mat (self, m):
         assert (m.is_matrice ())
-        self.init (0)
         left = self.dup ()
         for col in range (self._dim):
             for row in range (self._dim):
-                temp = 0
+                temp = _number (0)
                 for d in range (self._dim):
-                    temp += left.get_element (d, row) * m.get_element (col, d)
+                    temp += left.element (d, row) * m.element (col, d)
                 self.set_element (col, row, temp)
         return self
     def add_mat (self, m):
         assert (m.is_matrice ())
         result = self.dup ()
-        result.init (0)
-        for row in range (self._dim):
-            for col in range (self._dim):
-                result.set_element (col, row, self.get_element (col, row) + m.get_element (col, row))
+        result._elements = [a + b for a, b in zip (self._elements, m._elements)]
         return result
     def add_vec (self, vec):
         assert (vec.is_vec ())
         for row in range (self._dim):
             for col in range (self._dim):
-                self.set_element (col, row, self.get_element (col, row) + vec[col])
+                self.set_element (col, row, self.element (col, row) + vec.element (col))
         return self
     def sub (self, m):
         assert (m.is_matrice ())
         pass
-    def translate (self, vec):
-        assert (vec.is_vec ())
-        print ("mat.translate", vec)
-        self.identify ()
-        if self.length () == 4:
-            if vec.length () < 3:
-                error ("translate: vec must contain at least 3 elements")
-            print ("create a translation matrice based on", vec)
-            for col in range (self._dim):
-                if col <= 2:
-                    self.set_element (col).set_element (3, vec.element (col))
-            print ("finishing translate matrice", self)
-            return self
-        error ("translate: only dimension 4 understood")
     def _radian (self, degree):
-        return Decimal (degree) * Decimal (math.pi) / Decimal (180.0)
+        return _number (degree) * _number (math.pi) / _number (180.0)
     def rotate_x (self, angle):
         if self._dim == 2:
             error ("rotate_x: unimplemented")
@@ -443,24 +362,17 @@ class mat:
     def scale (self, vec):
         assert (vec.is_vec ())
         result = mat (self.length ())
-        result.zeros ()
-        print ("dim =, ", self._dim, vec, self._elements)
         for d in range (self._dim):
-            print ("d =", d)
             if d < vec.length ():
                 result.set_element (d, d, vec.element (d))
             else:
                 result.set_element (d, d, 1)
-        print ("finished scale", result)
         return result
     def translate (self, vec):
         assert (vec.is_vec ())
         result = mat (self.length ())
-        result.zeros ()
         result.identity ()
-        print (result)
         for d in range (self._dim -1):
-            print (self._dim-1, d)
             result.set_element (self._dim -1, d, vec.element (d))
         return result
     def reflect_x (self):
@@ -476,10 +388,10 @@ class mat:
         self.set_element (2, 2, -1.0)
         return self
     def ones (self):
-        self._elements = [1] * self._dim * self._dim
+        self.init (1)
         return self
     def zeros (self):
-        self._elements = [0] * self._dim * self._dim
+        self.init (0)
         return self
 
 #
@@ -519,6 +431,20 @@ class mat:
 #            [5, 4, 6, 7],    #  top
 #            [3, 0, 2, 1]]    #  bottom
 
+#
+#  vertice_octant - the (max_x, max_y, max_z) arguments which find_vert
+#                   passes to get_vertice for each label.
+#
+
+vertice_octant = {'a': (False, False, False),
+                  'b': (True, False, False),
+                  'c': (True, False, True),
+                  'd': (False, False, True),
+                  'e': (True, True, True),
+                  'f': (False, True, True),
+                  'g': (False, True, False),
+                  'h': (True, True, False)}
+
 class poly:
     def __init__ (self, vertices = []):
         self._no_faces = 0
@@ -644,19 +570,32 @@ class poly:
     def dump_vertice_list (self, vl):
         for i, vert in enumerate (vl):
             print (i, "vert =", vert)
+    #
+    #  _halves - sort vertices by dimension, dim, and return a dictionary
+    #            mapping up to the half get_vertice would keep after
+    #            sort_vert and bisect.  Ties are broken in the same order.
+    #
+    def _halves (self, vertices, dim):
+        ordered = sorted (vertices, key=lambda vert: -vert.element (dim))
+        half = len (ordered) // 2
+        upper = ordered[:half]
+        upper.reverse ()
+        return {True: ordered[half:], False: upper}
+    #
+    #  sort_vertices - reorder the vertices into the label order a..h.
+    #                  Rather than calling find_vert for each label the
+    #                  vertices are split in x, then y, then z once so
+    #                  the eight leaves are the vertices find_vert
+    #                  would return.
+    #
     def sort_vertices (self):
-        print ("sort_vert before")
-        self.dump_vertices ()
-        new_list = []
-        print (self.vertice_list ())
-        for label in self.vertice_list ():
-            print (label)
-            new_list += [self.find_vert (label)]
-        print ("sort_vertices new_list =")
-        self.dump_vertice_list (new_list)
-        self._vertices = new_list
-        print ("sorted vert complete")
-        self.dump_vertices ()
+        found = {}
+        for max_x, xhalf in self._halves (self._vertices, 0).items ():
+            for max_y, yhalf in self._halves (xhalf, 1).items ():
+                for max_z, zhalf in self._halves (yhalf, 2).items ():
+                    found[(max_x, max_y, max_z)] = zhalf[0]
+        self._vertices = [found[vertice_octant[label]]
+                          for label in self.vertice_list ()]
         return self
     def __str__ (self):
         s = "poly ("
@@ -728,136 +667,87 @@ class poly:
             error ("polygon does not have label: %s\n", label)
         return self
     #
+    #  _compose - follow any pending transform with the matrice, m.
+    #             Nothing is applied to the vertices until they are
+    #             next read, so a chain of transforms multiplies each
+    #             vertice only once.
+    #
+    def _compose (self, m):
+        if self._transform == None:
+            self._transform = m
+        else:
+            self._transform = m.mult_mat (self._transform)
+        return self
+    #
+    #  _vertices - the vertices with any pending transform applied.
+    #
+    @property
+    def _vertices (self):
+        if self._transform != None:
+            transform = self._transform
+            new_vertices = []
+            for vert in self._points:
+                vert = vert.dup ()
+                if self._extend:
+                    vert.extend (4, 1.0)
+                new_vertices += [vert.mult_mat (transform)]
+            self._vertices = new_vertices
+        return self._points
+    @_vertices.setter
+    def _vertices (self, vertices):
+        self._points = vertices
+        self._transform = None
+        self._extend = False
+    #
     #  rotate polygon about the x axis angle degrees.
     #
     def rotate_x (self, angle):
-        self.sanity_check ()
-        rotation_mat = mat (4).rotate_x (angle)
-        print (rotation_mat)
-        new_vertices = []
-        for vert in self._vertices:
-            print (vert)
-            new_vertices += [vert.mult_mat (rotation_mat)]
-        self._vertices = new_vertices
-        return self
+        return self._compose (mat (4).rotate_x (angle))
     #
     #  rotate polygon about the y axis angle degrees.
     #
     def rotate_y (self, angle):
-        self.sanity_check ()
-        rotation_mat = mat (4).rotate_y (angle)
-        new_vertices = []
-        for vert in self._vertices:
-            new_vertices += [vert.mult_mat (rotation_mat)]
-        self._vertices = new_vertices
-        return self
+        return self._compose (mat (4).rotate_y (angle))
     #
     #  rotate polygon about the z axis angle degrees.
     #
     def rotate_z (self, angle):
-        self.sanity_check ()
-        rotation_mat = mat (4).rotate_z (angle)
-        new_vertices = []
-        for vert in self._vertices:
-            new_vertices += [vert.mult_mat (rotation_mat)]
-        self._vertices = new_vertices
-        return self
+        return self._compose (mat (4).rotate_z (angle))
     #
     #  scale the polygon across the dimensions vec.
     #
     def scale (self, vec):
-        self.sanity_check ()
         assert (vec.is_vec ())
-        print (vec)
-        new_vertices = []
-        for vert in self._vertices:
-            print ("vert =", vert)
-            assert (vert.is_vec ())
-            new_vertices += [vert.mult_vec (vec)]
-        self._vertices = new_vertices
-        return self
+        return self._compose (mat (4).scale (vec))
     #
     #  translate move the polygon by vec.
     #
     def translate (self, vec):
-        print ("poly.translate")
-        self.sanity_check ()
         assert (vec.is_vec ())
-        print ("prior to translate old_vertices =")
-        for vert in self._vertices:
-            print (vert)
-            assert (vert.is_vec ())
-            print ("vert =", vert)
-        print ("poly.translate", vec)
-        translation_mat = mat (4).translate (vec)
-        print ("translate vec =", vec)
-        print ("translation_mat =", translation_mat)
-        print ("old_vertices =")
-        for vert in self._vertices:
-            print (vert)
-            assert (vert.is_vec ())
-            print ("vert =", vert)
-        new_vertices = []
-        for vert in self._vertices:
-            assert (vert.is_vec ())
-            print ("vert =", vert)
-            tvec = vert.mult_mat (translation_mat)
-            print ("translated vec =", tvec)
-            new_vertices += [tvec]
-        self._vertices = new_vertices
-        print ("new_vertices =", new_vertices)
-        for vert in self._vertices:
-            assert (vert.is_vec ())
-            print ("vert =", vert)
-        self.sanity_check ()
-        return self
+        return self._compose (mat (4).translate (vec))
     #
     #  reflect_x reflect polygon in the x axis.
     #
     def reflect_x (self):
-        self.sanity_check ()
-        reflection_mat = mat (4).reflect_x ()
-        new_vertices = []
-        for vert in self._vertices:
-            new_vertices += [reflection_mat.mult_vec (vert)]
-        self._vertices = new_vertices
-        return self
+        return self._compose (mat (4).reflect_x ())
     #
     #  reflect_y reflect polygon in the x axis.
     #
     def reflect_y (self):
-        self.sanity_check ()
-        reflection_mat = mat (4).reflect_y ()
-        new_vertices = []
-        for vert in self._vertices:
-            new_vertices += [reflection_mat.mult_vec (vert)]
-        self._vertices = new_vertices
-        return self
+        return self._compose (mat (4).reflect_y ())
     #
     #  reflect_z reflect polygon in the x axis.
     #
     def reflect_z (self):
-        self.sanity_check ()
-        reflection_mat = mat (4).reflect_z ()
-        new_vertices = []
-        for vert in self._vertices:
-            new_vertices += [reflection_mat.mult_vec (vert)]
-        self._vertices = new_vertices
-        return self
+        return self._compose (mat (4).reflect_z ())
     #
     #  mult - multiply each vertice using transform matric mat.
+    #         The vertices are extended to four dimensions.
     #
     def mult (self, mat):
-        self.sanity_check ()
         assert (mat.is_matrice ())
-        new_vertices = []
-        for vert in self._vertices:
-            vert.extend (4, 1.0)
-            print (vert)
-            print (mat)
-            new_vertices += [vert.mult_mat (mat)]
-        self._vertices = new_vertices
-        return self
+        self._extend = True
+        return self._compose (mat.dup ())
     def __eq__ (self, other):
         self.sanity_check ()
         if self.length () != other.length ():
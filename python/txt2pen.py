@@ -23,12 +23,18 @@
 #
 
 import sys, string, os, argparse
+from chgrid import grid
 
 inputFile = None
 defines = {}
-floor = []
+expandedNames = {}
+compiledDefines = {}
+entityTemplates = {}
+template = None
+floor = None
 rooms = {}
 maxx, maxy = 0, 0
+doorAdjacent = {}
 doorValue, wallValue, emptyValue = 0, -1, -2
 defaultColour = None
 openDoor, closedDoor, secretDoor = range (3)
@@ -53,45 +59,17 @@ def popInput ():
     return result
 
 
-def mycut (l, i):
-    if i == 0:
-        if len (l) > 1:
-            return None, l[i], l[i+1:]
-        return None, l[i], None
-    if len (l) > i+1:
-        return l[:i], l[i], l[i+1:]
-    return l[:i], l[i], None
-
-
-def mystitch (a, b, c):
-    if a == None:
-        d = b
-    else:
-        d = a + b
-    if c == None:
-        return d
-    return d + c
-
-
 def setFloor (x, y, value):
-    global floor
-    a, b, c = mycut (floor, y)
-    x, y, z = mycut (b, x)
-    b = mystitch (x, [value], z)
-    floor = mystitch (a, [b], c)
+    floor.set (x, y, value)
 
 
 def getFloor (x, y):
-    global floor
-    return floor[y][x]
+    return floor.get (x, y)
 
 
 def initFloor (x, y, value):
     global floor
-    floor = []
-    for j in range (y+1):
-        row = [value] * (x+1)
-        floor += [row]
+    floor = grid (x, y, value)
 
 
 class roomInfo:
@@ -300,30 +278,56 @@ def readMap (contents):
 
 #
 #  macro - return string, t, after decoding the macro definitions.
+#          Each [name] is replaced by the definition of name (or by
+#          name itself if it is not defined) and the replacement is
+#          itself decoded.  Brackets nest, the innermost name is
+#          decoded first and the string is scanned once.  active is
+#          the tuple of names currently being decoded and is used to
+#          detect a recursive definition.
+#
+
+def macro (t, active = ()):
+    stack = [""]
+    for c in t:
+        if c == '[':
+            stack += [""]
+        elif (c == ']') and (len (stack) > 1):
+            name = stack.pop ()
+            stack[-1] += macroName (name, active)
+        else:
+            stack[-1] += c
+    # any unterminated '[' is left in the string.
+    return "[".join (stack)
+
+
+#
+#  macroName - return the decoded replacement for [name].
+#              The result is cached in expandedNames.
 #
 
-def macro (t):
-    if t != "":
-        s = 0
-        i = 0
-        while i < len (t):
-            c = t[i]
-            if c == '[':
-                s = i
-                i += 1
-            elif c == ']':
-                if s < i:
-                    k = macro (t[s+1:i])
-                    if k in defines:
-                        k = defines[k]
-                        k = k.strip () + " "
-                    t = t[:s] + k + t[i+1:]
-                    i = 0
-                else:
-                    i += 1
-            else:
-                i += 1
-    return t
+def macroName (name, active):
+    if name in expandedNames:
+        return expandedNames[name]
+    if not (name in defines):
+        return name
+    if name in active:
+        error ("define %s is recursive via %s\n", name, " ".join (active))
+    k = macro (defines[name].strip () + " ", active + (name,))
+    expandedNames[name] = k
+    return k
+
+
+#
+#  compiledDefine - return a list containing the decoded text and the
+#                   tokenised text of define, c.  Each define is only
+#                   decoded and tokenised once.
+#
+
+def compiledDefine (c):
+    if not (c in compiledDefines):
+        k = macro (defines[c])
+        compiledDefines[c] = [k, tokenise (k)]
+    return compiledDefines[c]
 
 
 #
@@ -338,7 +342,7 @@ def getListOfRooms (mapGrid, start, i):
     for y, r in enumerate (mapGrid, start=1):
         for x, c in enumerate (r, start=1):
             if c in defines:
-                k = macro (defines[c])
+                k = compiledDefine (c)[0]
                 if isSubstr (k, 'room'):
                     pos += [[x, y]]
                     k = k.split ()[1:]
@@ -349,26 +353,72 @@ def getListOfRooms (mapGrid, start, i):
     return listOfRooms, pos
 
 
+#
+#  cell classification bits used by cellGrid.
+#
+
+wallBit, openBit, closedBit, secretBit, planeBit = 1, 2, 4, 8, 16
+doorBits = openBit | closedBit | secretBit
+cellBits = {'#': wallBit | planeBit,
+            '.': openBit | planeBit,
+            '-': closedBit | planeBit,
+            '|': closedBit | planeBit,
+            '=': secretBit | planeBit}
+
+
+#
+#  cellGrid - the map grid classified once into a flat array of cell bits.
+#             A border of empty cells surrounds the map so the tracers
+#             can probe one cell beyond any edge without a bounds check.
+#
+
+class cellGrid:
+    def __init__ (self, mapGrid):
+        self.width = 2
+        for line in mapGrid:
+            self.width = max (self.width, len (line) + 2)
+        self.cells = bytearray (self.width * (len (mapGrid) + 2))
+        for y, line in enumerate (mapGrid):
+            base = (y + 1) * self.width + 1
+            for x, c in enumerate (line):
+                if c in cellBits:
+                    self.cells[base + x] = cellBits[c]
+    #
+    #  at - return the classification bits of the cell at, pos.
+    #
+    def at (self, pos):
+        return self.cells[(pos[1] + 1) * self.width + pos[0] + 1]
+    #
+    #  code - return the integer cell code of position, pos.
+    #
+    def code (self, pos):
+        return (pos[1] + 1) * self.width + pos[0] + 1
+    #
+    #  pos - return the position [x, y] of the cell code, i.
+    #
+    def pos (self, i):
+        return [i % self.width - 1, i // self.width - 1]
+
+
 def isWall (pos, grid):
-    return grid[pos[1]][pos[0]] == '#'
+    return (grid.at (pos) & wallBit) != 0
 
 
 def isDoor (pos, grid):
-    return isOpen (pos, grid) or isClosed (pos, grid) or isSecret (pos, grid)
+    return (grid.at (pos) & doorBits) != 0
 
 def isSecret (pos, grid):
-    return grid[pos[1]][pos[0]] == '='
+    return (grid.at (pos) & secretBit) != 0
 
 
 def isClosed (pos, grid):
-    return ((grid[pos[1]][pos[0]] == '-') or
-            (grid[pos[1]][pos[0]] == '|'))
+    return (grid.at (pos) & closedBit) != 0
 
 def isOpen (pos, grid):
-    return grid[pos[1]][pos[0]] == '.'
+    return (grid.at (pos) & openBit) != 0
 
 def isPlane (pos, grid):
-    return isWall (pos, grid) or isDoor (pos, grid)
+    return (grid.at (pos) & planeBit) != 0
 
 
 def addVec (pos, vec):
@@ -399,131 +449,56 @@ def moveBy (pos, vec, grid):
 #  addWall - return the walls list and current point.
 #            Providing that the start is different to the current
 #            point then a new wall is added to the walls list.
+#            start and current are cell codes of, grid.
 #
 
-def addWall (walls, start, current):
+def addWall (walls, start, current, grid):
     if start != current:
-        walls += [[start, current]]
+        walls += [[grid.pos (start), grid.pos (current)]]
     return walls, current
 
 
-def lookingLeft (pos, left, grid, s):
-    if args.debug:
-        print(pos, left, s)
-    if s[1] == ' ' and isPlane (pos, grid):
-        return False
-    if s[1] == 'x' and (not isPlane (pos, grid)):
-        return False
-    if s[1] == '.' and (not isDoor (pos, grid)):
-        if args.debug:
-            print("no door at", pos)
-        return False
-    if s[0] == ' ' and isPlane (addVec (pos, left), grid):
-        return False
-    if s[0] == 'x' and (not isPlane (addVec (pos, left), grid)):
-        return False
-    if s[0] == '.' and (not isDoor (addVec (pos, left), grid)):
+#
+#  patternBits - maps each lookingLeft pattern character onto the cell
+#                bits tested and whether they must be present:
+#                ' ' is an empty cell, 'x' is a wall or door and '.' is a door.
+#
+
+patternBits = {' ': (planeBit, False),
+               'x': (planeBit, True),
+               '.': (doorBits, True)}
+
+
+#
+#  lookingLeft - return True if the cell at code, i, and the cell to its
+#                left (at i+left) match the pattern, s.  s[1] describes
+#                the cell at i and s[0] the cell to its left.
+#
+
+def lookingLeft (cells, i, left, s):
+    mask, present = patternBits[s[1]]
+    if ((cells[i] & mask) != 0) != present:
         return False
-    return True
+    mask, present = patternBits[s[0]]
+    return ((cells[i + left] & mask) != 0) == present
 
 def mystop ():
     pass
 
 
-def getDoorType (p, mapGrid):
-    if isOpen (p, mapGrid):
+#
+#  getDoorType - return the door type from the cell bits, c.
+#
+
+def getDoorType (c):
+    if c & openBit:
         return openDoor
-    if isClosed (p, mapGrid):
+    if c & closedBit:
         return closedDoor
-    if isSecret (p, mapGrid):
+    if c & secretBit:
         return secretDoor
 
 
-def scanRoom (topleft, p, mapGrid, walls, doors):
-    if args.debug:
-        print("scanning room, start pos in room = ", p)
-    s = addVec (p, [0, 0])
-    a = addVec (p, [-1, -1])
-    d = 1  # 0 up, 1 right, 2 down, 3 left
-    leftVec = [[-1, 0], [0, -1], [1, 0], [0, 1]]
-    forwardVec = [[0, -1], [1, 0], [0, 1], [-1, 0]]
-    if args.debug:
-        print("wall corner", p)
-
-    doorStartPoint = None
-    doorEndPoint = None
-    doorType = None
-    while True:
-        if args.debug:
-            print("point currently at", p, d)
-        if (doorStartPoint == None) and lookingLeft (p, leftVec[d], mapGrid, '. '):
-            if args.debug:
-                print("seen first point", p)
-            # first point on the wall is a door
-            doorStartPoint = addVec (p, leftVec[d])
-            doorEndPoint = doorStartPoint
-            doorType = getDoorType (doorStartPoint, mapGrid)
-        if lookingLeft (addVec (p, forwardVec[d]), leftVec[d], mapGrid, '. '):
-            if args.debug:
-                print("seen a door point", p, end=' ')
-            if doorStartPoint == None:
-                doorStartPoint = addVec (addVec (p, forwardVec[d]), leftVec[d])
-                doorType = getDoorType (doorStartPoint, mapGrid)
-            doorEndPoint = addVec (addVec (p, forwardVec[d]), leftVec[d])
-        else:
-            # end of door?
-            if doorEndPoint != None:
-                doors += [[doorStartPoint, doorEndPoint, doorType]]
-                doorStartPoint = None
-                doorEndPoint = None
-        if lookingLeft (addVec (p, forwardVec[d]), leftVec[d], mapGrid, 'x '):
-            # carry on
-            p = addVec (p, forwardVec[d])
-        elif lookingLeft (addVec (p, forwardVec[d]), leftVec[d], mapGrid, 'x.'):
-            if args.debug:
-                print("wall corner (x.)", p)
-            walls, a = addWall (walls, a, addVec (addVec (p, forwardVec[d]), leftVec[d]))
-            # end of door?
-            if doorEndPoint != None:
-                doors += [[doorStartPoint, doorEndPoint, doorType]]
-            doorStartPoint = None
-            doorEndPoint = None
-            # turn right
-            d = (d + 1) % 4
-            if s == p:
-                # back to the start
-                return walls, doors
-        elif lookingLeft (addVec (p, forwardVec[d]), leftVec[d], mapGrid, 'xx'):
-            if args.debug:
-                print("wall corner (xx)", p)
-            walls, a = addWall (walls, a, addVec (addVec (p, forwardVec[d]), leftVec[d]))
-            # end of door?
-            if doorEndPoint != None:
-                doors += [[doorStartPoint, doorEndPoint]]
-            doorStartPoint = None
-            doorEndPoint = None
-            # turn right
-            d = (d + 1) % 4
-            if s == p:
-                # back to the start
-                return walls, doors
-        elif lookingLeft (addVec (p, forwardVec[d]), leftVec[d], mapGrid, '  '):
-            if args.debug:
-                print("wall corner (  )", p, end=' ')
-            # walls, a = addWall (walls, a, addVec (addVec (p, forwardVec[d]), leftVec[d]))
-            walls, a = addWall (walls, a, addVec (p, leftVec[d]))
-            if args.debug:
-                print("at point", a)
-            # turn left
-            p = addVec (p, forwardVec[d])
-            d = (d + 3) % 4
-            if s == p:
-                # back to the start
-                return walls, doors
-        else:
-            error ("scanning room at %s has gone wrong, maybe the room is too small\n", p)
-
-
 #
 #  checkLight - add a mid light if lightCount == args.freq
 #
@@ -540,137 +515,130 @@ def checkLight (position, lightList, lightCount):
 
 
 #
-#  introduceLights - returns a list of lights which are dropped
-#                    near the perimeter of the wall.  The algorithm
-#                    walks around the wall touching the left hand edge
-#                    (it moves clockwise).
-#                    Pre-condition:  p is the start point and it will
-#                                    be touching a left hand wall.
-#                                    mapGrid is the 2D map a list of lists.
-#                                    walls is a list of walls.
-#                                    doors is a list of doors.
-#                    Post-condition: a list of lights is returned.
-#
-
-"""
-def introduceLights (p, mapGrid, walls, doors):
-    global debuging
-
-    s = p
-    a = addVec (p, [-1, -1])
-    d = 1  # 0 up, 1 right, 2 down, 3 left
-    leftVec = [[-1, 0], [0, -1], [1, 0], [0, 1]]
-    forwardVec = [[0, -1], [1, 0], [0, 1], [-1, 0]]
+#  traceRoom - walk once around the perimeter of a room touching the
+#              left hand wall (it moves clockwise) and return the walls,
+#              the doors and the automatic lights dropped near the
+#              perimeter.  Positions are held as cell codes of the
+#              cellGrid, grid, and the directions are tables of code
+#              offsets.
+#              Pre-condition:  p is the start point and it will
+#                              be touching a left hand wall.
+#              Post-condition: walls, doors, lights are returned.
+#
+
+def traceRoom (p, grid):
+    cells = grid.cells
+    width = grid.width
+    # 0 up, 1 right, 2 down, 3 left
+    leftVec = [-1, -width, 1, width]
+    forwardVec = [-width, 1, width, -1]
+    s = grid.code (p)
+    i = s
+    a = grid.code ([p[0]-1, p[1]-1])
+    d = 1
     if args.debug:
         print("wall corner", p)
 
-    lightCount = 0
-    lights = []
+    walls = []
+    doors = []
     doorStartPoint = None
     doorEndPoint = None
-    needToAvoidDoor = False
-    # your code goes here, complete this function.
-    return []
-"""
-
-
-#
-#  introduceLights - returns a list of lights which are dropped
-#                    near the perimeter of the wall.  The algorithm
-#                    walks around the wall touching the left hand edge
-#                    (it moves clockwise).
-#                    Pre-condition:  p is the start point and it will
-#                                    be touching a left hand wall.
-#                                    mapGrid is the 2D map a list of lists.
-#                                    walls is a list of walls.
-#                                    doors is a list of doors.
-#                    Post-condition: a list of lights is returned.
-#
-
-def introduceLights (p, mapGrid, walls, doors):
-    s = p
-    a = addVec (p, [-1, -1])
-    d = 1  # 0 up, 1 right, 2 down, 3 left
-    leftVec = [[-1, 0], [0, -1], [1, 0], [0, 1]]
-    forwardVec = [[0, -1], [1, 0], [0, 1], [-1, 0]]
-    if args.debug:
-        print("wall corner", p)
+    doorType = None
 
-    lightCount = 0
     lights = []
-    doorStartPoint = None
-    doorEndPoint = None
-    # your code goes here, complete this function.
+    lightCount = 0
+    passingDoor = False
     suppressDoor = False
-
     while True:
-        # print (p)
         if args.debug:
-            print("point currently at", p, d)
-        if (doorStartPoint == None) and lookingLeft (p, leftVec[d], mapGrid, '. '):
-            if args.debug:
-                print("seen first point", p)
-            # first point on the wall is a door
-            doorEndPoint = doorStartPoint
+            print("point currently at", grid.pos (i), d)
+        left = leftVec[d]
+        f = i + forwardVec[d]
+        if lookingLeft (cells, i, left, '. '):
+            if doorStartPoint == None:
+                if args.debug:
+                    print("seen first point", grid.pos (i))
+                # first point on the wall is a door
+                doorStartPoint = i + left
+                doorEndPoint = doorStartPoint
+                doorType = getDoorType (cells[doorStartPoint])
+            passingDoor = False
             suppressDoor = True
-        if lookingLeft (addVec (p, forwardVec[d]), leftVec[d], mapGrid, '. '):
+        if lookingLeft (cells, f, left, '. '):
             if args.debug:
-                print("seen a door point", p, end=' ')
+                print("seen a door point", grid.pos (i), end=' ')
+            if doorStartPoint == None:
+                doorStartPoint = f + left
+                doorType = getDoorType (cells[doorStartPoint])
+            doorEndPoint = f + left
+            passingDoor = True
             suppressDoor = True
-            doorEndPoint = addVec (addVec (p, forwardVec[d]), leftVec[d])
         else:
             # end of door?
             if doorEndPoint != None:
-                doorEndPoint = None
+                doors += [[grid.pos (doorStartPoint), grid.pos (doorEndPoint), doorType]]
                 doorStartPoint = None
+                doorEndPoint = None
+            if passingDoor:
+                passingDoor = False
                 suppressDoor = True
-        if lookingLeft (addVec (p, forwardVec[d]), leftVec[d], mapGrid, 'x '):
+        if lookingLeft (cells, f, left, 'x '):
             # carry on
             if suppressDoor:
                 li = light ()
                 li.settype ('FLOOR')
-                lights += [p + [li]]
+                lights += [grid.pos (i) + [li]]
             else:
-                lights, lightCount = checkLight (p, lights, lightCount)
-            p = addVec (p, forwardVec[d])
+                lights, lightCount = checkLight (grid.pos (i), lights, lightCount)
+            i = f
             suppressDoor = False
-        elif lookingLeft (addVec (p, forwardVec[d]), leftVec[d], mapGrid, 'x.'):
+        elif lookingLeft (cells, f, left, 'x.'):
             if args.debug:
-                print("wall corner (x.)", p)
+                print("wall corner (x.)", grid.pos (i))
+            walls, a = addWall (walls, a, f + left, grid)
             # end of door?
+            if doorEndPoint != None:
+                doors += [[grid.pos (doorStartPoint), grid.pos (doorEndPoint), doorType]]
             doorStartPoint = None
             doorEndPoint = None
+            passingDoor = False
             suppressDoor = True
             # turn right
             d = (d + 1) % 4
-            if s == p:
+            if s == i:
                 # back to the start
-                return lights
-        elif lookingLeft (addVec (p, forwardVec[d]), leftVec[d], mapGrid, 'xx'):
+                return walls, doors, lights
+        elif lookingLeft (cells, f, left, 'xx'):
             if args.debug:
-                print("wall corner (xx)", p)
+                print("wall corner (xx)", grid.pos (i))
+            walls, a = addWall (walls, a, f + left, grid)
             # end of door?
+            if doorEndPoint != None:
+                doors += [[grid.pos (doorStartPoint), grid.pos (doorEndPoint)]]
             doorStartPoint = None
             doorEndPoint = None
+            passingDoor = False
             suppressDoor = False
             # turn right
             d = (d + 1) % 4
-            if s == p:
+            if s == i:
                 # back to the start
-                return lights
-        elif lookingLeft (addVec (p, forwardVec[d]), leftVec[d], mapGrid, '  '):
+                return walls, doors, lights
+        elif lookingLeft (cells, f, left, '  '):
+            if args.debug:
+                print("wall corner (  )", grid.pos (i), end=' ')
+            walls, a = addWall (walls, a, i + left, grid)
             if args.debug:
-                print("wall corner (  )", p, end=' ')
+                print("at point", grid.pos (a))
             # turn left
-            p = addVec (p, forwardVec[d])
+            i = f
             d = (d + 3) % 4
             suppressDoor = True   # dont want a light on the obtuse corner of a wall
-            if s == p:
+            if s == i:
                 # back to the start
-                return lights
+                return walls, doors, lights
         else:
-            error ("introduceLights at %s has gone wrong, maybe the room is too small\n", p)
-    return lights
+            error ("scanning room at %s has gone wrong, maybe the room is too small\n", grid.pos (i))
 
 
 def printCoord (c, o):
@@ -804,12 +772,11 @@ def generateRoom (roomNo, position, mapGrid, start, lineNo):
     position = moveBy (position, [-1, -1], mapGrid)
     if args.debug:
         print ("top left is", position)
-    start = position
-    walls, doors = scanRoom (start, position, mapGrid, [], [])
+    walls, doors, lights = traceRoom (position, mapGrid)
     if args.debug:
         print(walls)
     rooms[roomNo] = roomInfo (walls, doors)
-    rooms[roomNo].autoLights += introduceLights (position, mapGrid, [], [])
+    rooms[roomNo].autoLights += lights
     rooms[roomNo].inside = inside
 
 
@@ -847,7 +814,7 @@ def findMax (r):
 
 def dumpFloor ():
     print("the map")
-    for r in floor:
+    for r in floor.rows ():
         for c in r:
             if c == emptyValue:
                 print(" ", end=' ')
@@ -861,19 +828,23 @@ def dumpFloor ():
     print(" ")
 
 
-def floodFloor (r, p):
-    if p[0] >= 0 and p[1] >= 0:
-        if getFloor (p[0], p[1]) == emptyValue:
-            setFloor (p[0], p[1], r)
-            floodFloor (r, [p[0]-1, p[1]])
-            floodFloor (r, [p[0]+1, p[1]])
-            floodFloor (r, [p[0], p[1]-1])
-            floodFloor (r, [p[0], p[1]+1])
-
+#
+#  labelRooms - label the floor of every room in a single pass over the grid.
+#               Each room is seeded from its position in, pos, and the
+#               neighbours of the first cell of every door are recorded
+#               so findDoors does not need to probe the grid.
+#
 
-def floodRoom (r, p):
-    # printf ("r = %s\n", r)
-    floodFloor (int (r), p)
+def labelRooms (listOfRooms, pos):
+    global doorAdjacent
+    seeds = []
+    for roomNo, position in zip (listOfRooms, pos):
+        seeds += [[position, int (roomNo)]]
+    probes = []
+    for roomNo in listOfRooms:
+        for d in rooms[roomNo].doors:
+            probes += [d[0]]
+    doorAdjacent = floor.label (emptyValue, seeds, probes)
 
 
 #
@@ -925,18 +896,19 @@ def findWall (r, d):
 def findDoors (r, p):
     for d in rooms[r].doors:
         w = findWall (r, d)
+        left, right, above, below = doorAdjacent[(d[0][0], d[0][1])]
         if isVertical (w):
             # vertical door as it is on a vertical wall
-            if getFloor (d[0][0]+1, d[0][1]) != int (r):
-                rooms[r].doorLeadsTo += [getFloor (d[0][0]+1, d[0][1])]
+            if right != int (r):
+                rooms[r].doorLeadsTo += [right]
             else:
-                rooms[r].doorLeadsTo += [getFloor (d[0][0]-1, d[0][1])]
+                rooms[r].doorLeadsTo += [left]
         else:
             # horizontal door as it is on a horizontal wall
-            if getFloor (d[0][0], d[0][1]+1) != int (r):
-                rooms[r].doorLeadsTo += [getFloor (d[0][0], d[0][1]+1)]
+            if below != int (r):
+                rooms[r].doorLeadsTo += [below]
             else:
-                rooms[r].doorLeadsTo += [getFloor (d[0][0], d[0][1]-1)]
+                rooms[r].doorLeadsTo += [above]
 
 #
 #  light - define the characteristics of the light
@@ -1018,6 +990,84 @@ class column:
         return f
 
 
+#
+#  entityTemplate - the compiled form of a define.  The define is
+#                   parsed once and each entity found is recorded as
+#                   an action, a spawn function and its arguments.
+#                   instantiate binds the actions to a room and
+#                   grid position.
+#
+
+class entityTemplate:
+    def __init__ (self):
+        self.actions = []
+    def emit (self, action, *args):
+        self.actions += [[action, args]]
+    def instantiate (self, room, x, y):
+        for action, args in self.actions:
+            action (room, x, y, *args)
+
+
+#
+#  the spawn functions below add a compiled entity to, room, at x, y.
+#
+
+def checkRoomNo (room, x, y, i):
+    assert (i == int (room))
+
+
+def spawnWorld (room, x, y):
+    rooms[room].worldspawn += [[x, y]]
+
+
+def spawnAmmo (room, x, y, s, n):
+    rooms[room].ammo += [[s, n, [x, y]]]
+
+
+def spawnWeapon (room, x, y, n):
+    rooms[room].weapons += [[n, [x, y]]]
+
+
+def spawnMonster (room, x, y, name):
+    rooms[room].monsters += [[name, [x, y]]]
+
+
+def spawnLight (room, x, y, l):
+    rooms[room].lights += [[x, y, l]]
+
+
+def spawnDefaultColour (room, x, y, t, colour):
+    rooms[room].defaultColour[t] = colour
+
+
+def spawnDefaultTexture (room, x, y, t, texture):
+    rooms[room].defaultTexture[t] = texture
+
+
+def spawnSound (room, x, y, filename, volume, looping, wait):
+    s = sound ([x, y], filename)
+    s.volume = volume
+    s.looping = looping
+    s.wait = wait
+    rooms[room].sounds += [s]
+
+
+def spawnLabel (room, x, y, desc):
+    rooms[room].labels += [label ([x, y], desc)]
+
+
+def spawnPlinth (room, x, y, h):
+    rooms[room].plinths += [plinth (x, y, h)]
+
+
+def spawnStaircase (room, x, y, orient, clockwise, up, dest):
+    rooms[room].stairs += [staircase (room, x, y, orient, clockwise, up, dest)]
+
+
+def spawnColumn (room, x, y):
+    rooms[room].columns += [column (x, y)]
+
+
 #
 #  ebnf := roomNo | worldSpawn | ammoSpawn | lightSpawn | configDefaults | monsterSpawn |
 #          weaponSpawn | soundSpawn | label | plinth | staircase =:
@@ -1183,7 +1233,6 @@ def parseConfigDefaults (room, x, y):
 #
 
 def parseLightDefault (room, x, y):
-    global rooms
     expect ('light', room, x, y)
     if expecting (['floor']):
         expect ('floor', room, x, y)
@@ -1206,7 +1255,7 @@ def parseLightDefault (room, x, y):
     else:
         error ("expecting floor, mid or ceil after default in room " +
                str (room) + " at " + str (x) + " " + str (y))
-    rooms[room].defaultColour[l.gettype ()] = [l.r, l.g, l.b]
+    template.emit (spawnDefaultColour, l.gettype (), [l.r, l.g, l.b])
 
 
 #
@@ -1215,7 +1264,7 @@ def parseLightDefault (room, x, y):
 
 def parseSound (room, x, y):
     filename = expectString (room, x, y, 'a filename after the sound keyword')
-    s = sound ([x, y], filename)
+    s = sound (None, filename)
     while expecting (['volume', 'looping', 'wait']):
         if expecting (['volume']):
             expect ('volume', room, x, y)
@@ -1228,7 +1277,7 @@ def parseSound (room, x, y):
             expect ('wait', room, x, y)
             n = expectInt (room, x, y, 'a number and quantity after the wait keyword')
             s.setWait (n)
-    rooms[room].sounds += [s]
+    template.emit (spawnSound, filename, s.volume, s.looping, s.wait)
 
 
 #
@@ -1237,8 +1286,7 @@ def parseSound (room, x, y):
 
 def parseLabel (room, x, y):
     desc = expectString (room, x, y, 'a string after the label keyword')
-    l = label ([x, y], desc)
-    rooms[room].labels += [l]
+    template.emit (spawnLabel, desc)
 
 
 #
@@ -1262,7 +1310,7 @@ def parseStaircase (room, x, y):
 def parseColumn (room, x, y):
     if expecting (['column']):
         expect ('column', room, x, y)
-        rooms[room].columns += [column (x, y)]
+        template.emit (spawnColumn)
         return True
     return False
 
@@ -1325,8 +1373,7 @@ def parseStairTo (room, x, y, orient, clockwise, up):
     expect ('to', room, x, y)
     dest = expectInt (room, x, y,
                       "staircase needs a destination 'to' room")
-    stair = staircase (room, x, y, orient, clockwise, up, dest)
-    rooms[room].stairs += [stair]
+    template.emit (spawnStaircase, orient, clockwise, up, dest)
 
 
 #
@@ -1375,7 +1422,7 @@ def parseRoomNo (room, x, y):
     if expecting (['room']):
         expect ('room', room, x, y)
         i = expectInt (room, x, y, "room number")
-        assert (i == int (room))
+        template.emit (checkRoomNo, i)
         return True
     return False
 
@@ -1385,10 +1432,9 @@ def parseRoomNo (room, x, y):
 #
 
 def parseWorldSpawn (room, x, y):
-    global rooms
     if expecting (['worldspawn']):
         expect ('worldspawn', room, x, y)
-        rooms[room].worldspawn += [[x, y]]
+        template.emit (spawnWorld)
         return True
     return False
 
@@ -1398,7 +1444,6 @@ def parseWorldSpawn (room, x, y):
 #
 
 def parseAmmoSpawn (room, x, y):
-    global rooms
     if expecting (['ammo']):
         if args.debug:
             print("before", tokens)
@@ -1407,7 +1452,7 @@ def parseAmmoSpawn (room, x, y):
             print("after", tokens)
         s = expectString (room, x, y, 'describing ammo')
         n = expectInt (room, x, y, 'amount of ammo')
-        rooms[room].ammo += [[s, n, [x, y]]]
+        template.emit (spawnAmmo, s, n)
         return True
     return False
 
@@ -1417,11 +1462,10 @@ def parseAmmoSpawn (room, x, y):
 #
 
 def parseWeaponSpawn (room, x, y):
-    global rooms
     if expecting (['weapon']):
         expect ('weapon', room, x, y)
         n = expectInt (room, x, y, 'a number and quantity after the keyword weapon')
-        rooms[room].weapons += [[n, [x, y]]]
+        template.emit (spawnWeapon, n)
         return True
     return False
 
@@ -1431,11 +1475,10 @@ def parseWeaponSpawn (room, x, y):
 #
 
 def parseMonsterSpawn (room, x, y):
-    global rooms
     if expecting (['monster']):
         expect ('monster', room, x, y)
         name = expectString (room, x, y, 'a string after the keyword monster')
-        rooms[room].monsters += [[name, [x, y]]]
+        template.emit (spawnMonster, name)
         return True
     return False
 
@@ -1445,11 +1488,10 @@ def parseMonsterSpawn (room, x, y):
 #
 
 def parseLightSpawn (room, x, y):
-    global rooms
     if expecting (['light']):
         while expecting (['light']):
             l = parseLightObject (room, x, y)
-            rooms[room].lights += [[x, y, l]]
+            template.emit (spawnLight, l)
         return True
     return False
 
@@ -1508,23 +1550,27 @@ def parseConfigDefault (room, x, y):
 #
 
 def parseTextureDefault (room, x, y):
-    global rooms
     expect ('texture', room, x, y)
     if expecting (['floor']):
         expect ('floor', room, x, y)
-        rooms[room].defaultTexture['FLOOR'] = expectString (room, x, y, 'a texture after the floor keyword')
+        template.emit (spawnDefaultTexture, 'FLOOR',
+                       expectString (room, x, y, 'a texture after the floor keyword'))
     elif expecting (['ceiling']):
         expect ('ceiling', room, x, y)
-        rooms[room].defaultTexture['CEILING'] = expectString (room, x, y, 'a texture after the ceiling keyword')
+        template.emit (spawnDefaultTexture, 'CEILING',
+                       expectString (room, x, y, 'a texture after the ceiling keyword'))
     elif expecting (['wall']):
         expect ('wall', room, x, y)
-        rooms[room].defaultTexture['WALL'] = expectString (room, x, y, 'a texture after the wall keyword')
+        template.emit (spawnDefaultTexture, 'WALL',
+                       expectString (room, x, y, 'a texture after the wall keyword'))
     elif expecting (['plinth']):
         expect ('plinth', room, x, y)
-        rooms[room].defaultTexture['PLINTH'] = expectString (room, x, y, 'a texture after the plinth keyword')
+        template.emit (spawnDefaultTexture, 'PLINTH',
+                       expectString (room, x, y, 'a texture after the plinth keyword'))
     elif expecting (['beam']):
         expect ('beam', room, x, y)
-        rooms[room].defaultTexture['BEAM'] = expectString (room, x, y, 'a texture after the beam keyword')
+        template.emit (spawnDefaultTexture, 'BEAM',
+                       expectString (room, x, y, 'a texture after the beam keyword'))
     else:
         error ("expecting floor, ceiling, wall, plinth or beam after the texture keyword\n")
 
@@ -1550,8 +1596,7 @@ def parsePlinth (room, x, y):
         expect ('plinth', room, x, y)
         expect ('height', room, x, y)
         h = expectInt (room, x, y, 'a height integer quantity after the height keyword')
-        p = plinth (x, y, h)
-        rooms[room].plinths += [p]
+        template.emit (spawnPlinth, h)
         return True
     return False
 
@@ -1569,52 +1614,76 @@ def parseSoundSpawn (room, x, y):
 
 
 #
-#  parseEntities - parse the entities described in, k, in, room, at position, x, y.
+#  parseEntities - parse the tokenised entities, t, and return the
+#                  entityTemplate.  room, x, y is the first position
+#                  the define is used and is only used to report errors.
 #
 
-def parseEntities (k, room, x, y):
-    global tokens
+def parseEntities (t, room, x, y):
+    global tokens, template
 
-    tokens = tokenise (k)
+    tokens = t
+    template = entityTemplate ()
     if args.debug:
         print (tokens)
     ebnf (room, x, y)
+    return template
 
 
 #
-#  findEntities - scan a room and use the definitions to yield a string
-#                 which is then parsed.
+#  compiledEntity - return the entityTemplate for define, c, which is
+#                   first seen in, room, at x, y.  Each define is
+#                   only parsed once.
 #
 
-def findEntities (mapGrid, room, p):
+def compiledEntity (c, room, x, y):
+    if not (c in entityTemplates):
+        k, t = compiledDefine (c)
+        if args.debug:
+            print ("pos", x, y, c, "=>", k)
+        entityTemplates[c] = parseEntities (t, room, x, y)
+    return entityTemplates[c]
+
+
+#
+#  findEntities - scan the map grid once and bucket every define
+#                 character found on the floor of a room in, listOfRooms.
+#                 It returns a dictionary mapping the room floor value
+#                 to the list of [x, y, c] entities in grid order.
+#
+
+def findEntities (mapGrid, listOfRooms):
     if args.debug:
         for line in mapGrid:
             print (line, end=' ')
-        printf ("floor list for room %s\n", room)
-        for line in floor:
+        printf ("floor list\n")
+        for line in floor.rows ():
             print (line)
         dumpFloor ()
+    buckets = {}
+    for roomNo in listOfRooms:
+        buckets[int (roomNo)] = []
     for y, gridLine in enumerate (mapGrid):
         if args.debug:
             printf ("gridLine = %s, y = %d\n", gridLine, y)
         for x in range (maxx+1):
-            if args.debug:
-                printf ("gridLine = %s, x, y = %d, %d\n", gridLine, x, y)
-                printf ("getFloor (%d, %d) = %d\n", x, y, getFloor (x, y))
-            if getFloor (x, y) == int (room):
-                if args.debug:
-                    printf ("getFloor matches, finding entities now\n")
+            value = getFloor (x, y)
+            if value in buckets:
                 c = gridLine[x]
-                if args.debug:
-                    printf ("  entity %s\n", c)
                 if c in defines:
                     if args.debug:
-                        print ("seen", c, "at", x, y)
-                        print ("pos", x, y, c, "=>", end=' ')
-                    k = macro (defines[c])
-                    if args.debug:
-                        print (k)
-                    parseEntities (k, room, x, y)
+                        print ("seen", c, "at", x, y, "in room", value)
+                    buckets[value] += [[x, y, c]]
+    return buckets
+
+
+#
+#  parseRoomEntities - parse each entity in, entities, found in room, room.
+#
+
+def parseRoomEntities (room, entities):
+    for x, y, c in entities:
+        compiledEntity (c, room, x, y).instantiate (room, x, y)
 
 
 #
@@ -1629,9 +1698,10 @@ def generatePen (mapGrid, start, fileContents, outputFile):
     if listOfRooms == []:
         errorLine (start, mapGrid[0], "the map must have at least one room defined")
     else:
+        cells = cellGrid (mapGrid)
         for roomNo, position in zip (listOfRooms, pos):
             vprintf ("[%s]", roomNo)
-            generateRoom (roomNo, position, mapGrid, start, fileContents)
+            generateRoom (roomNo, position, cells, start, fileContents)
         vprintf ("\n")
         for roomNo in listOfRooms:
             findMax (roomNo)
@@ -1639,19 +1709,18 @@ def generatePen (mapGrid, start, fileContents, outputFile):
         for roomNo in listOfRooms:
             onFloor (roomNo)
         vprintf ("floor: ")
-        for roomNo, position in zip (listOfRooms, pos):
-            vprintf ("[%s]", roomNo)
-            floodRoom (roomNo, position)
-        vprintf ("\n")
+        labelRooms (listOfRooms, pos)
+        vprintf ("done\n")
         vprintf ("doors: ")
         for roomNo, position in zip (listOfRooms, pos):
             vprintf ("[%s]", roomNo)
             findDoors (roomNo, position)
         vprintf ("\n")
         vprintf ("entities: ")
-        for roomNo, position in zip (listOfRooms, pos):
+        buckets = findEntities (mapGrid, listOfRooms)
+        for roomNo in listOfRooms:
             vprintf ("[%s]", roomNo)
-            findEntities (mapGrid, roomNo, position)
+            parseRoomEntities (roomNo, buckets[int (roomNo)])
         vprintf ("\n")
         for roomNo in listOfRooms:
             outputFile = printRoom (roomNo, outputFile)
@@ -23,57 +23,30 @@
 #
 
 import getopt, sys, string
+from chgrid import grid
 
 inputFile = None
 defines = {}
 verbose = False
 debugging = False
-floor = []
+floor = None
 rooms = {}
 maxx, maxy = 0, 0
 doorValue, wallValue, emptyValue = 0, -1, -2
 versionNumber = 0.1
 
 
-def mycut (l, i):
-    if i == 0:
-        if len (l) > 1:
-            return None, l[i], l[i+1:]
-        return None, l[i], None
-    if len (l) > i+1:
-        return l[:i], l[i], l[i+1:]
-    return l[:i], l[i], None
-
-
-def mystitch (a, b, c):
-    if a == None:
-        d = b
-    else:
-        d = a + b
-    if c == None:
-        return d
-    return d + c
-
-
 def setFloor (x, y, value):
-    global floor
-    a, b, c = mycut (floor, y)
-    x, y, z = mycut (b, x)
-    b = mystitch (x, [value], z)
-    floor = mystitch (a, [b], c)
+    floor.set (x, y, value)
 
 
 def getFloor (x, y):
-    global floor
-    return floor[y][x]
+    return floor.get (x, y)
 
 
 def initFloor (x, y, value):
     global floor
-    floor = []
-    for j in range (y+1):
-        row = [value] * (x+1)
-        floor += [row]
+    floor = grid (x, y, value)
 
 
 class roomInfo:
@@ -491,7 +464,7 @@ def findMax (r):
 
 def dumpFloor ():
     print("the map")
-    for r in floor:
+    for r in floor.rows ():
         for c in r:
             if c == emptyValue:
                 print(" ", end=' ')
@@ -505,18 +478,18 @@ def dumpFloor ():
     print(" ")
 
 
+#
+#  floodFloor - fill the empty floor region containing, p, with room number, r.
+#               It returns the number of cells filled and the bounding box
+#               [[minx, miny], [maxx, maxy]] of the region.
+#
+
 def floodFloor (r, p):
-    if p[0] >= 0 and p[1] >= 0:
-        if getFloor (p[0], p[1]) == emptyValue:
-            setFloor (p[0], p[1], r)
-            floodFloor (r, [p[0]-1, p[1]])
-            floodFloor (r, [p[0]+1, p[1]])
-            floodFloor (r, [p[0], p[1]-1])
-            floodFloor (r, [p[0], p[1]+1])
+    return floor.flood (p[0], p[1], emptyValue, r)
 
 
 def floodRoom (r, p):
-    floodFloor (int (r), p)
+    return floodFloor (int (r), p)
 
 
 #
@@ -586,7 +559,7 @@ def findEntities (g, room, p):
     if debugging:
         for l in g:
             print(l, end=' ')
-        for l in floor:
+        for l in floor.rows ():
             print(l)
     for y, r in enumerate (g):
         for x in range (maxx+1):